@@ -0,0 +1,288 @@
+"""
+Bulk building of the LOC/ALA and phonological caches from verified
+conversions.
+
+Each pair of a romanized title and its verified Hebrew form is decoded and
+matched word by word with cacheutils.form_builder. Worker processes count the
+forms for batches of pairs, the counts are merged in the main process and
+added to the CacheDB in one transaction at the end, so the database sees each
+distinct form once instead of once per occurrence.
+
+    build-arc-cache --checked -j 4
+    build-arc-cache --pairs nli-matches.tsv
+"""
+import argparse
+import collections
+import itertools
+import sys
+import time
+from deromanize import cacheutils as dc
+from . import cacheutils as cu
+
+# exceptions from decoding a line, as in util.LineConverter
+DECODE_ERRORS = IndexError, KeyError, ValueError
+
+
+class FormCollector:
+    """decodes (romanized, Hebrew) pairs and counts the LOC/ALA and
+    phonological forms for each matched Hebrew word.
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        to_new = decoder.profile["to_new"]
+        self.form_builder = cu.form_builder_factory(
+            to_new["replacements"], to_new["sets"]
+        )
+
+    def collect(self, pairs):
+        """returns Counters of (loc, heb) and (phon, heb) pairs and a Counter
+        with the number of pairs, matched pairs, words and rejected pairs by
+        reason.
+        """
+        loc, phon, stats = (collections.Counter() for _ in range(3))
+        make_chunks = self.decoder.make_chunks
+        form_builder = self.form_builder
+        for rom, heb in pairs:
+            stats["pairs"] += 1
+            try:
+                forms = form_builder(make_chunks(rom).heb, heb)
+            except cu.NoMatch:
+                stats["NoMatch"] += 1
+                continue
+            except cu.FieldError:
+                stats["FieldError"] += 1
+                continue
+            except DECODE_ERRORS:
+                stats["decode_error"] += 1
+                continue
+            stats["matched"] += 1
+            for hebform, locform, phonform in forms:
+                # punctuation matches itself and is left empty by
+                # remove_prefixes. Empty forms can't be looked up anyway.
+                if not hebform:
+                    continue
+                stats["words"] += 1
+                if locform:
+                    loc[locform, hebform] += 1
+                if phonform:
+                    phon[phonform, hebform] += 1
+        return loc, phon, stats
+
+
+# collector for the current worker process
+_collector = None
+
+
+def init_collector(standard="old", config_path=None):
+    global _collector
+    from . import config
+
+    decoder = config.Config(config_path).from_schema(
+        standard, fix_numerals=True
+    )
+    _collector = FormCollector(decoder)
+
+
+def collect_batch(pairs):
+    return _collector.collect(pairs)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def collect_forms(
+    pairs, standard="old", config_path=None, batch_size=500, jobs=1
+):
+    """count the forms for an iterable of (romanized, Hebrew) pairs. With
+    more than one job, batches are counted in worker processes and their
+    counts merged as they come back. Returns the same three Counters as
+    FormCollector.collect.
+    """
+    loc, phon, stats = (collections.Counter() for _ in range(3))
+
+    def merge(result):
+        for total, part in zip((loc, phon, stats), result):
+            total.update(part)
+
+    if jobs <= 1:
+        init_collector(standard, config_path)
+        for batch in batches(pairs, batch_size):
+            merge(collect_batch(batch))
+        return loc, phon, stats
+
+    import multiprocessing
+
+    with multiprocessing.Pool(
+        jobs, init_collector, (standard, config_path)
+    ) as pool:
+        pending = collections.deque()
+        for batch in batches(pairs, batch_size):
+            pending.append(pool.apply_async(collect_batch, (batch,)))
+            if len(pending) >= jobs * 2:
+                merge(pending.popleft().get())
+        while pending:
+            merge(pending.popleft().get())
+    return loc, phon, stats
+
+
+def _lookup(session, column, values, *criteria, chunksize=500):
+    """dictionary of the rows where ``column`` is one of ``values``, keyed
+    on the value of the column. Extra criteria go in the filter.
+    """
+    values = list(values)
+    found = {}
+    for i in range(0, len(values), chunksize):
+        query = session.query(column.class_).filter(
+            column.in_(values[i : i + chunksize]), *criteria
+        )
+        found.update((getattr(row, column.key), row) for row in query)
+    return found
+
+
+def merge_counts(cache, counts):
+    """add a Counter of (source, target) pairs to a CacheDB. Existing rows
+    are looked up in bulk rather than with a few queries for each pair as
+    in CacheDB.add, which also starts new pairs at a count of 1 whatever
+    count it's given. Nothing is committed.
+    """
+    session = cache.db.session
+    standard = session.query(dc.Standard).filter(
+        dc.Standard.st == cache.standard
+    ).first() or dc.Standard(st=cache.standard)
+    session.add(standard)
+    session.flush()
+
+    originals = _lookup(session, dc.Original.form, {t for _, t in counts})
+    romanized = _lookup(
+        session,
+        dc.Romanized.form,
+        {s for s, _ in counts},
+        dc.Romanized.standard_id == standard.id,
+    )
+    for source, target in counts:
+        if target not in originals:
+            originals[target] = dc.Original(form=target)
+            session.add(originals[target])
+        if source not in romanized:
+            romanized[source] = dc.Romanized(form=source, standard=standard)
+            session.add(romanized[source])
+    session.flush()
+
+    matches = {}
+    rom_ids = [r.id for r in romanized.values()]
+    for i in range(0, len(rom_ids), 500):
+        query = session.query(dc.Match).filter(
+            dc.Match.romanized_id.in_(rom_ids[i : i + 500])
+        )
+        matches.update(((m.romanized_id, m.original_id), m) for m in query)
+    for (source, target), count in counts.items():
+        key = romanized[source].id, originals[target].id
+        match = matches.get(key)
+        if match is None:
+            session.add(
+                dc.Match(romanized_id=key[0], original_id=key[1], count=count)
+            )
+        else:
+            match.count += count
+
+
+def merge_forms(loc_cache, phon_cache, loc, phon):
+    """add counted forms to the caches. Both caches share a database, so
+    everything is committed in a single transaction.
+    """
+    with loc_cache:
+        merge_counts(loc_cache, loc)
+        merge_counts(phon_cache, phon)
+
+
+def read_pairs(lines):
+    """(romanized, Hebrew) pairs from tab-separated lines, e.g. titles
+    matched with NLI records. Lines without a tab are skipped.
+    """
+    for line in lines:
+        rom, sep, heb = line.rstrip("\n").partition("\t")
+        if sep and rom and heb:
+            yield rom, heb
+
+
+def report(stats, seconds, file=sys.stderr):
+    pairs = stats["pairs"]
+    print(
+        "{} pairs in {:.1f}s ({:.1f} pairs/s)".format(
+            pairs, seconds, pairs / seconds if seconds else 0
+        ),
+        file=file,
+    )
+    print(
+        "matched: {} ({} words)".format(stats["matched"], stats["words"]),
+        file=file,
+    )
+    print(
+        "rejected: NoMatch {}, FieldError {}, decoding errors {}".format(
+            stats["NoMatch"], stats["FieldError"], stats["decode_error"]
+        ),
+        file=file,
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="add forms from verified conversions to the LOC/ALA and "
+        "phonological caches"
+    )
+    source = ap.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--checked",
+        action="store_true",
+        help="use the corrected titles in the ARC database",
+    )
+    source.add_argument(
+        "--pairs",
+        metavar="FILE",
+        help="tab-separated romanized and Hebrew titles, one pair per line "
+        "('-' for stdin)",
+    )
+    ap.add_argument("--config", help="config file (default: the user's)")
+    ap.add_argument("--standard", default="old")
+    ap.add_argument(
+        "--jobs", "-j", type=int, default=1, help="worker processes"
+    )
+    ap.add_argument(
+        "--batch-size", type=int, default=500, help="pairs per batch"
+    )
+    ap.add_argument(
+        "--dry-run",
+        "-n",
+        action="store_true",
+        help="count the forms, but don't write them to the caches",
+    )
+    args = ap.parse_args()
+
+    from . import config
+
+    cfg = config.Config(args.config)
+    if args.checked:
+        pairs = cfg.get_db().verified_pairs()
+    elif args.pairs == "-":
+        pairs = read_pairs(sys.stdin)
+    else:
+        pairs = read_pairs(open(args.pairs))
+
+    start = time.perf_counter()
+    loc, phon, stats = collect_forms(
+        pairs, args.standard, args.config, args.batch_size, args.jobs
+    )
+    if not args.dry_run:
+        merge_forms(*cfg.get_caches("LOC/ALA", "phonological"), loc, phon)
+    report(stats, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    main()
@@ -19,19 +19,14 @@
 import re
 import unicodedata
 from . import decode
+from . import spelling
+from .candidates import Candidates
 import deromanize as dr
 from deromanize import cacheutils
 from typing import NamedTuple, Tuple
 
 CacheObject, CacheDB = cacheutils.CacheObject, cacheutils.CacheDB
 NOCHECK = {"־", "h", "ה", "-", "։", ";"}
-try:
-    from HspellPy import Hspell
-
-    hspell = Hspell(linguistics=True)
-except ImportError as e:
-    hspell = None
-    hspell_error = e
 
 
 class FieldError(Exception):
@@ -49,12 +44,52 @@ class NoMatch(Exception):
         )
 
 
-def loc_converter_factory(simple_reps, set_reps):
-    replace = cacheutils.replacer_maker(simple_reps, set_reps)
+class LocConverter:
+    """converts Replacements to LOC/ALA romanization. Does the same as
+    stripping vowels with deromanize's strip_chars and then running its
+    replacer_maker function on each key/value pair, but a pair is only
+    converted the first time it's seen. Whole keyvalues are memoized too.
+    """
+
+    def __init__(self, simple_reps, set_reps, maxsize=2 ** 16):
+        self.pair_reps = {tuple(v): k for k, v in set_reps.items()}
+        self.simple_reps = simple_reps
+        # replacements of single characters which don't produce other keys
+        # give the same result in one pass as one after the other.
+        if all(len(k) == 1 for k in simple_reps) and not any(
+            k in v for k in simple_reps for v in simple_reps.values()
+        ):
+            self.table = str.maketrans(simple_reps)
+        else:
+            self.table = None
+        self.pairs = {}
+        self.maxsize = maxsize
+        self.cache = {}
 
-    def get_loc(rep):
-        flat_vowels = cacheutils.strip_chars(rep.keyvalue)
-        loc = "".join((i[0] for i in replace(flat_vowels)))
+    def convert_pair(self, pair):
+        """LOC/ALA for one key/value pair"""
+        try:
+            return self.pairs[pair]
+        except KeyError:
+            pass
+        (stripped,) = cacheutils.strip_chars([pair])
+        new = self.pair_reps.get(stripped)
+        if new is None:
+            new = stripped[0]
+            if self.table is not None:
+                new = new.translate(self.table)
+            else:
+                for k, v in self.simple_reps.items():
+                    new = new.replace(k, v)
+        self.pairs[pair] = new
+        return new
+
+    def convert(self, keyvalue):
+        pairs = self.pairs
+        try:
+            loc = "".join([pairs[pair] for pair in keyvalue])
+        except KeyError:
+            loc = "".join([self.convert_pair(pair) for pair in keyvalue])
         if len(loc) > 1:
             if loc[0] == "ʾ":
                 loc = loc[1:]
@@ -63,7 +98,114 @@ def loc_converter_factory(simple_reps, set_reps):
             loc = loc.replace("-ʾ", "-")
         return loc
 
-    return get_loc
+    def __call__(self, rep):
+        keyvalue = rep.keyvalue
+        cache = self.cache
+        try:
+            return cache[keyvalue]
+        except KeyError:
+            pass
+        except TypeError:
+            return self.convert(tuple(map(tuple, keyvalue)))
+        if len(cache) >= self.maxsize:
+            cache.clear()
+        loc = cache[keyvalue] = self.convert(keyvalue)
+        return loc
+
+
+class CacheLookup:
+    """memoizing front for a deromanize CacheDB. Each lookup of a romanized
+    form in the CacheDB is a query with three joins; here a form is only
+    queried the first time it's seen, and many forms can be fetched at once
+    with ``prefetch``. Forms added through the wrapper are forgotten, so the
+    next lookup sees the new counts. Changes made to the database any other
+    way aren't seen until the form is dropped from the memo.
+
+    The dictionaries returned are shared between lookups and must not be
+    modified.
+    """
+
+    def __init__(self, cache, maxsize=2 ** 16):
+        self.cache = cache
+        self.maxsize = maxsize
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.cache[key]
+        memo = self.memo
+        try:
+            result = memo[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+        self.misses += 1
+        if len(memo) >= self.maxsize:
+            memo.clear()
+        result = memo[key] = self.cache[key]
+        return result
+
+    def prefetch(self, keys, chunksize=500):
+        """look up romanized forms which aren't in the memo yet, with one
+        query for every ``chunksize`` forms. No more forms than fit in the
+        memo are fetched. Returns the number of forms fetched.
+        """
+        memo = self.memo
+        keys = [k for k in dict.fromkeys(keys) if k and k not in memo]
+        del keys[self.maxsize :]
+        if len(memo) + len(keys) > self.maxsize:
+            memo.clear()
+        Romanized, Original, Match, Standard = (
+            cacheutils.Romanized,
+            cacheutils.Original,
+            cacheutils.Match,
+            cacheutils.Standard,
+        )
+        session = self.cache.db.session
+        for i in range(0, len(keys), chunksize):
+            found = {k: {} for k in keys[i : i + chunksize]}
+            query = (
+                session.query(Romanized.form, Original.form, Match.count)
+                .join(Match, Match.romanized_id == Romanized.id)
+                .join(Original, Original.id == Match.original_id)
+                .join(Standard, Standard.id == Romanized.standard_id)
+                .filter(
+                    Romanized.form.in_(list(found)),
+                    Standard.st == self.cache.standard,
+                )
+            )
+            for rom, orig, count in query:
+                found[rom][orig] = count
+            memo.update(found)
+        return len(keys)
+
+    def add(self, source, target, count=1, addr=None):
+        self.memo.pop(source, None)
+        self.cache.add(source, target, count, addr)
+
+    def clear(self):
+        self.memo.clear()
+
+    def __enter__(self):
+        self.cache.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self.cache.__exit__(*args)
+
+    def __iter__(self):
+        return iter(self.cache)
+
+
+def loc_converter_factory(simple_reps, set_reps):
+    return LocConverter(simple_reps, set_reps)
 
 
 def loc2phon(loc):
@@ -190,18 +332,81 @@ def get_stats(rep_dict: dict, cached_vals: dict, key):
     return matched, unmatched, uncached
 
 
-def get_newreps(keys, cache, ignore=None):
-    matched = []
-    unmatched = []
+class CachedForms(NamedTuple):
+    """parallel lists with one item for every cached form found for the keys
+    of a replist. ``reps`` holds the generated Replacement for the form, or
+    None if the form was only found in the cache.
+    """
+
+    keys: list
+    hebs: list
+    counts: list
+    totals: list
+    reps: list
+
+
+def flatten_cached(keys, cache, ignore=frozenset()):
+    """look up all keys in the cache and collect the results into a
+    CachedForms instance. Also returns a list of the generated replacements
+    which weren't found in the cache. Nothing in ``keys`` or ``cache`` is
+    modified. Forms in ``ignore`` are skipped entirely.
+    """
+    forms = CachedForms([], [], [], [], [])
     uncached = []
     for k, rep_dict in keys.items():
         cached = cache[k]
-        # singular = True if len(cached) == 1 else False
-        ignore_seen(ignore, rep_dict, cached)
-        m, um, uc = get_stats(rep_dict, cached, k)
-        matched += m
-        unmatched += um
-        uncached += uc
+        pairs = [(h, c) for h, c in cached.items() if h not in ignore]
+        total = sum(c for _, c in pairs)
+        for heb, count in pairs:
+            forms.keys.append(k)
+            forms.hebs.append(heb)
+            forms.counts.append(count)
+            forms.totals.append(total)
+            forms.reps.append(rep_dict.get(heb))
+        uncached.extend(
+            rep
+            for heb, rep in rep_dict.items()
+            if heb not in ignore and heb not in cached
+        )
+    return forms, uncached
+
+
+def reweigh(forms: CachedForms):
+    """compute new weights for all cached forms in a single pass. Forms which
+    were also generated get the mean of their cache frequency and their
+    original weight. The rest just get the cache frequency.
+    """
+    return [
+        count / total if rep is None else (count / total) / 2 + rep.weight / 2
+        for count, total, rep in zip(forms.counts, forms.totals, forms.reps)
+    ]
+
+
+def rank_cached(forms: CachedForms, group=0):
+    """apply the weights from reweigh() and return a list of
+    ``(rank, replacement)`` pairs. Generated replacements which were found in
+    the cache get ``group`` as their rank. Forms which were only in the cache
+    are turned into new StatReps and get ``group + 1``.
+    """
+    ranked = []
+    weights = reweigh(forms)
+    for key, heb, weight, rep in zip(
+        forms.keys, forms.hebs, weights, forms.reps
+    ):
+        if rep is None:
+            ranked.append((group + 1, dr.StatRep.new(weight, heb, key)))
+        else:
+            rep.weight = weight
+            ranked.append((group, rep))
+    return ranked
+
+
+def get_newreps(keys, cache, ignore=None):
+    forms, uncached = flatten_cached(keys, cache, set(ignore or ()))
+    matched = []
+    unmatched = []
+    for rank, rep in rank_cached(forms):
+        (unmatched if rank else matched).append(rep)
     return matched, unmatched, uncached
 
 
@@ -212,6 +417,18 @@ class MatchInfo(NamedTuple):
     recognized: bool
 
 
+def unmatched(chunk, decoder, compact=False):
+    if not compact:
+        return dr.fix_gershayim_late(chunk.heb)
+    # fixing the parts fixes every combination, without building them.
+    candidates = chunk.candidates
+    return Candidates.product(
+        [dr.fix_gershayim_late(part) for part in candidates.parts],
+        candidates.keyparts,
+        decoder.strings,
+    )
+
+
 def match_cached(
     chunk,
     decoder,
@@ -219,25 +436,32 @@ def match_cached(
     phon_cache,
     spelling_fallback=False,
     dictionary=None,
+    compact=False,
 ) -> Tuple[dr.ReplacementList, MatchInfo]:
+    """rerank the candidates for a chunk with forms from the caches. With
+    ``compact``, the result is an arc.candidates.Candidates instance instead
+    of a ReplacementList.
+    """
     candidate = False
     cached = False
     # singular = False
     recognized = False
 
     if not isinstance(chunk, decode.Chunk):
+        if compact:
+            chunk = Candidates.from_replist(chunk, decoder.strings)
         return chunk, MatchInfo(candidate, cached, recognized)
 
     rlist = chunk.base.stripped_heb.makestat()
     key = rlist.key
     if key == str(rlist[0]) or key in NOCHECK or len(key) <= 1:
-        return dr.fix_gershayim_late(chunk.heb), MatchInfo(
+        return unmatched(chunk, decoder, compact), MatchInfo(
             candidate, cached, recognized
         )
     for rep in rlist[:10]:
         try:
             int(str(rep))
-            return dr.fix_gershayim_late(chunk.heb), MatchInfo(
+            return unmatched(chunk, decoder, compact), MatchInfo(
                 candidate, cached, recognized
             )
         except ValueError:
@@ -245,35 +469,25 @@ def match_cached(
 
     candidate = True
     loc_keys, phon_keys = collect_keys(rlist, decoder)
-    matchedloc, unmatchedloc, _ = get_newreps(loc_keys, loc_cache)
-    if matchedloc or unmatchedloc:
-        cached = True
-    ignore = [str(r) for r in matchedloc]
-    ignore += [str(r) for r in unmatchedloc]
-    matchedphon, unmatchedphon, uncached = get_newreps(
-        phon_keys, phon_cache, ignore
+    locforms, _ = flatten_cached(loc_keys, loc_cache)
+    phonforms, uncached = flatten_cached(
+        phon_keys, phon_cache, set(locforms.hebs)
     )
-    if matchedphon or unmatchedphon:
-        cached = True
-    cached = []
-    for reps in (matchedloc, unmatchedloc, matchedphon, unmatchedphon):
-        reps.sort(key=lambda r: r.weight, reverse=True)
-        cached.extend(reps)
+    cached = bool(locforms.hebs or phonforms.hebs)
+    ranked = rank_cached(locforms, 0) + rank_cached(phonforms, 2)
 
     if spelling_fallback or dictionary:
         spelling_ok = False
         dict_ok = False
+        if spelling_fallback:
+            known = spelling.get_checker().check_many(
+                map(str, uncached), linginfo=True
+            )
         for r in uncached:
             r.weight /= 2
             heb = str(r)
-            if spelling_fallback:
-                try:
-                    if hspell.check_word(heb) and hspell.linginfo(heb):
-                        spelling_ok = True
-                except UnicodeEncodeError:
-                    pass
-                except AttributeError:
-                    raise hspell_error
+            if spelling_fallback and known[heb]:
+                spelling_ok = True
             if dictionary and dictionary.get(heb):
                 dict_ok
 
@@ -282,6 +496,12 @@ def match_cached(
             else:
                 r.weight /= 100
 
-    uncached.sort(key=lambda r: r.weight, reverse=True)
-    new_rlist = dr.ReplacementList(rlist.keyparts, cached + uncached)
-    return chunk.basemerge(new_rlist), MatchInfo(candidate, cached, recognized)
+    ranked.extend((4, r) for r in uncached)
+    # one sort for everything: cache groups first, then by weight. Python's
+    # sort is stable, so ties keep the order they were found in.
+    ranked.sort(key=lambda pair: (pair[0], -pair[1].weight))
+    new_rlist = dr.ReplacementList(rlist.keyparts, [r for _, r in ranked])
+    return (
+        chunk.basemerge(new_rlist, compact=compact),
+        MatchInfo(candidate, cached, recognized),
+    )
@@ -0,0 +1,238 @@
+"""
+Compact storage for decoder output.
+
+A ReplacementList holds a Replacement object with its own weight and tuple of
+key/value pairs for every candidate, and the replist for a chunk is the
+product of the replists for its parts, so every combination gets new objects.
+Candidates only stores an array with the weight of each combination, plus the
+parts' replists, which are shared (see Decoder.token_cache). The Hebrew for a
+combination is joined from its parts when it's read, so a chunk with
+thousands of combinations costs one array, and the strings are only built for
+the few candidates which are actually used. Replacement objects are only
+created again by Candidates.to_replist().
+"""
+import itertools
+from array import array
+from typing import NamedTuple
+import deromanize as dr
+from deromanize.keygenerator import StatRepList
+
+
+class StringTable:
+    """interns the strings built for candidates, so the same candidate for
+    the same chunk is one string object. Each decoder has its own. The table
+    is emptied when it's full.
+    """
+
+    def __init__(self, maxsize=2 ** 16):
+        self.strings = {}
+        self.maxsize = maxsize
+
+    def intern(self, string):
+        strings = self.strings
+        try:
+            return strings[string]
+        except KeyError:
+            if len(strings) >= self.maxsize:
+                strings.clear()
+            strings[string] = string
+            return string
+
+    def clear(self):
+        self.strings.clear()
+
+    def __len__(self):
+        return len(self.strings)
+
+
+_empty = dr.get_empty_replist()
+
+
+class Candidate(NamedTuple):
+    """one item from Candidates. str() gives the Hebrew, like a
+    Replacement.
+    """
+
+    heb: str
+    weight: float
+
+    def __str__(self):
+        return self.heb
+
+
+def weight_array(weights):
+    weights = list(weights)
+    if all(type(w) is int for w in weights):
+        return array("q", weights)
+    return array("d", weights)
+
+
+class Candidates:
+    """array-backed, read-only alternative to a ReplacementList."""
+
+    __slots__ = "keyparts", "weights", "parts", "order", "stat", "table"
+
+    def __init__(
+        self, keyparts, weights, parts, order=None, stat=False, table=None
+    ):
+        """
+        - keyparts: like ReplacementList.keyparts
+        - weights: array with the weight of every combination of the parts,
+          in the same order as itertools.product
+        - parts: tuple of the ReplacementLists the candidates are built from
+        - order: array of positions in ``weights`` if the candidates aren't
+          in product order, e.g. after sorting
+        - stat: True if the weights are probabilities, like StatReps
+        - table: StringTable for the Hebrew strings, if any
+        """
+        self.keyparts = keyparts
+        self.weights = weights
+        self.parts = parts
+        self.order = order
+        self.stat = stat
+        self.table = table
+
+    @classmethod
+    def from_replist(cls, rlist, table=None):
+        return cls(
+            rlist.keyparts,
+            weight_array(r.weight for r in rlist.data),
+            (rlist,),
+            None,
+            isinstance(rlist, StatRepList),
+            table,
+        )
+
+    @classmethod
+    def product(cls, rlists, keyparts=None, table=None):
+        """compact equivalent of deromanize.add_rlists. If ``keyparts`` is
+        given, it's used instead of the keyparts of the first combination.
+        Only the weights are computed here.
+        """
+        rlists = tuple(rlists) or (_empty,)
+        stat = any(isinstance(rl, StatRepList) for rl in rlists)
+        if stat:
+            rlists = tuple(rl.makestat() for rl in rlists)
+        if keyparts is None:
+            keyparts = ()
+            for rl in rlists:
+                keyparts += rl[0].keyparts
+
+        weights = [1 if stat else 0]
+        for rl in rlists:
+            col = [r.weight for r in rl.data]
+            if stat:
+                weights = [a * b for a in weights for b in col]
+            else:
+                weights = [a + b for a in weights for b in col]
+        return cls(keyparts, weight_array(weights), rlists, None, stat, table)
+
+    @property
+    def key(self):
+        return "".join(self.keyparts)
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __bool__(self):
+        return bool(self.weights)
+
+    def _reps(self, position):
+        """the Replacement from each part for the combination at
+        ``position`` in product order.
+        """
+        reps = []
+        for rl in reversed(self.parts):
+            position, i = divmod(position, len(rl.data))
+            reps.append(rl.data[i])
+        reps.reverse()
+        return reps
+
+    def _heb(self, position):
+        string = "".join([str(r) for r in self._reps(position)])
+        if self.table is None:
+            return string
+        return self.table.intern(string)
+
+    def _positions(self, n=None):
+        if self.order is None:
+            return range(len(self.weights) if n is None else n)
+        return itertools.islice(self.order, n)
+
+    def __getitem__(self, i):
+        if self.order is None:
+            position = range(len(self.weights))[i]
+        else:
+            position = self.order[i]
+        return Candidate(self._heb(position), self.weights[position])
+
+    def __iter__(self):
+        weights = self.weights
+        for position in self._positions():
+            yield Candidate(self._heb(position), weights[position])
+
+    def __repr__(self):
+        return "Candidates({!r}, {!r})".format(self.key, list(self))
+
+    def strings(self):
+        return [self._heb(position) for position in self._positions()]
+
+    def top(self, n=None):
+        """list of the first n candidates (all if n is None)"""
+        if n is not None:
+            n = min(n, len(self.weights))
+        weights = self.weights
+        return [
+            Candidate(self._heb(position), weights[position])
+            for position in self._positions(n)
+        ]
+
+    def keyvalue(self, i):
+        position = i if self.order is None else self.order[i]
+        keyvalue = ()
+        for rep in self._reps(position):
+            keyvalue += rep.keyvalue
+        return keyvalue
+
+    def sorted(self, reverse=False):
+        """new Candidates sorted by weight. The sort is stable."""
+        weights = self.weights
+        order = sorted(
+            self._positions(), key=weights.__getitem__, reverse=reverse
+        )
+        return type(self)(
+            self.keyparts,
+            weights,
+            self.parts,
+            array("L", order),
+            self.stat,
+            self.table,
+        )
+
+    def makestat(self):
+        """like ReplacementList.makestat"""
+        if self.stat:
+            return self
+        reciprocals = [1 / (w + 1) for w in self.weights]
+        total = sum(reciprocals)
+        return type(self)(
+            self.keyparts,
+            array("d", [r / total for r in reciprocals]),
+            self.parts,
+            self.order,
+            True,
+            self.table,
+        )
+
+    def to_replist(self):
+        """convert back to a deromanize ReplacementList (or StatRepList)"""
+        if self.stat:
+            rep, rlist = dr.StatRep, StatRepList
+        else:
+            rep, rlist = dr.Replacement, dr.ReplacementList
+        new = rlist(self.keyparts)
+        weights = self.weights
+        new.data = []
+        for i, position in enumerate(self._positions()):
+            new.data.append(rep(weights[position], self.keyvalue(i)))
+        return new
@@ -2,11 +2,17 @@
 kinds of other useful things for retro-conversion.
 """
 from pathlib import Path
+import asyncio
+import collections
+import functools
+import sys
+import unicodedata
 import libaaron
 import deromanize
 import enum
-from . import filters
+from . import filters, profiles
 from .decode import Decoder
+from .instrument import timed
 from typing import NamedTuple
 
 CACHE_NAMES = "DIN1982", "LOC/ALA", "phonological"
@@ -42,17 +48,28 @@ class Config(deromanize.Config):
             self.ppn_file = None
         self._term_paths = [Path(p).expanduser() for p in nli["terms"]]
 
-    def from_schema(self, schema_name, *args, **kwargs):
+    def from_schema(self, schema_name, *args, compiled=None, **kwargs):
         """build a decoder from a schema_name. *args and **kwargs are
-        passed on to arc.decode.Decoder.
+        passed on to arc.decode.Decoder. With ``compiled``, keys compiled
+        with arc-compile-profile are used if they are up to date. Compiled
+        profiles are pickles, so they are only loaded if they're asked for,
+        here or with ``compiled_profiles: true`` in the config file.
         """
 
-        profile = self.loader(self.schemas[schema_name])
+        path = self.schemas[schema_name]
+        if compiled is None:
+            compiled = self.user_conf.get("compiled_profiles", False)
+        keys = profiles.load_compiled(path) if compiled else None
+        if keys is None:
+            profile = self.loader(path)
+        else:
+            profile = keys.profile
         return Decoder(
             profile,
             *args,
             fix_k=profile.get("fix_k"),
             name=schema_name,
+            keys=keys,
             **kwargs
         )
 
@@ -103,33 +120,53 @@ class ConversionInfo(NamedTuple):
 class Session:
     _sessions = {}
     filters = filters
+    # bounds for the pickdecoder memos, by string and by character set
+    pick_maxsize = 2 ** 16
+    charset_maxsize = 2 ** 12
 
-    def __init__(self, config: Config, asynchro=False):
+    def __init__(self, config: Config, asynchro=False, executor=None):
         """
         config -- a Config instance to pull data from
+        asynchro -- use asynchronous Solr cores
+        executor -- a concurrent.futures executor for the ``*_async``
+                    methods. A single worker thread is started for them if
+                    it isn't given.
         """
         # NLI stuff
         self.cores = libaaron.DotDict()
         self.termdict = None
+        self.spellchecker = None
+        self.authorities = None
+        self.instruments = None
         self.asynchro = asynchro
+        self.executor = executor
         # Not NLI stuff
         self.config = config
         try:
             self.records = config.get_db()
         except AttributeError:
             pass
+        from . import cacheutils as cu
+
         self.caches = c = libaaron.DotDict()
-        c.din, c.loc, c.phon = self.config.get_caches(*CACHE_NAMES)
+        c.din, loc, phon = self.config.get_caches(*CACHE_NAMES)
+        # lookups in usecache are memoized, see Session.warm
+        c.loc, c.phon = cu.CacheLookup(loc), cu.CacheLookup(phon)
         self.decoders = libaaron.DotDict()
+        self.pick_cache = {}
+        self.charset_cache = {}
+        # Standards detected by pickdecoder, by name
+        self.standards = collections.Counter()
 
     @classmethod
     def fromconfig(cls, path=None, loader=None, asynchro=False):
         """takes the same arguments as the ``Config`` initializer,
         constructs the config object and uses it to build a session.
         """
-        s = cls._sessions.get((path, loader))
+        key = path, loader, asynchro
+        s = cls._sessions.get(key)
         if not s:
-            s = cls._sessions[path, loader, asynchro] = cls(
+            s = cls._sessions[key] = cls(
                 Config(path=path, loader=loader), asynchro=asynchro
             )
         return s
@@ -151,54 +188,187 @@ class Session:
     def add_decoders(self, names, *args, **kwargs):
         return [self.add_decoder(name, *args, **kwargs) for name in names]
 
+    def instrument(
+        self, interval=None, prometheus_path=None, stream=sys.stderr
+    ):
+        """turn on timers and counters for decoding, cache matching, spell
+        checking and Solr queries. Stage times are inclusive, so
+        ``getchunks`` includes ``pickdecoder``.
+
+        - interval: report every ``interval`` seconds (only checked when
+          something is timed).
+        - prometheus_path: write metrics to this file in the Prometheus text
+          format on each report.
+        - stream: where to print summaries on each report. None to disable.
+
+        Returns the arc.instrument.Instruments instance. Call its
+        ``report()`` method to report at any time.
+        """
+        from .instrument import Instruments
+
+        inst = self.instruments = Instruments(
+            interval, prometheus_path, stream
+        )
+        for core in self.cores.values():
+            core.instruments = inst
+
+        def spelling_counts():
+            checker = self.spellchecker
+            if not checker:
+                return {}
+            return {
+                "spelling_cache_hits": checker.hits,
+                "hspell_calls": checker.misses,
+            }
+
+        def authority_counts():
+            authorities = self.authorities
+            if not authorities:
+                return {}
+            return {
+                "authority_cache_hits": authorities.hits,
+                "authority_cache_misses": authorities.misses,
+            }
+
+        def lookup_counts():
+            counts = {}
+            for name in ("loc", "phon"):
+                cache = self.caches[name]
+                counts[name + "_lookup_hits"] = cache.hits
+                counts[name + "_lookup_misses"] = cache.misses
+            return counts
+
+        def standard_counts():
+            return {
+                "standard_" + name: n for name, n in self.standards.items()
+            }
+
+        inst.add_collector(spelling_counts)
+        inst.add_collector(authority_counts)
+        inst.add_collector(lookup_counts)
+        inst.add_collector(standard_counts)
+        return inst
+
+    def warm(self, path=None, top=None, prefetch=True):
+        """decode the most frequent tokens ahead of time and look up their
+        cached forms in bulk, so the first titles converted aren't slower
+        than the rest. The tokens are read from a warm-cache file written by
+        arc-warm-cache at ``path`` (or the ``warm_cache`` path in the user
+        config), unless a dictionary from arc.warmup.top_tokens is given as
+        ``top``. Add the decoders first; tokens for other decoders are
+        skipped.
+
+        Returns a Counter with the numbers of tokens and forms loaded.
+        """
+        from . import warmup
+
+        if top is None:
+            path = path or self.config.user_conf.get("warm_cache")
+            top = warmup.load(Path(path).expanduser())
+        return warmup.warm(self, top, prefetch)
+
+    @timed("pickdecoder")
     def pickdecoder(self, string: str):
+        """the decoder for the standard a string seems to be in and an
+        InputInfo. Results are memoized by string. The tests for the
+        standard only look at which characters a string has, so for a string
+        that isn't in the memo, they are done once for each character set
+        and only the tests for foreign tokens are run on the string itself
+        (see _pick for the exception).
+        """
+        picked = self.pick_cache
+        try:
+            name, info = picked[string]
+        except KeyError:
+            name, info = self._pick(string)
+            if len(picked) >= self.pick_maxsize:
+                picked.clear()
+            picked[string] = name, info
+        self.standards[info.standard.name] += 1
+        return getattr(self.decoders, name), info
+
+    def _pick(self, string):
         line = filters.Line(string)
-        has_old, has_new, only_new, only_pi, only_old, ascii_letters = map(
-            line.has,
-            ("old", "new", "only_new", "only_pi", "only_old", "ascii_letters"),
-        )
+        charset = frozenset(string)
+        by_charset = self.charset_cache
+        try:
+            name, standard, transliteration_tokens = by_charset[charset]
+        except KeyError:
+            name, standard = self._pick_standard(line)
+            transliteration_tokens = line.has("transliteration")
+            # the haschars and onlycharset tests look at one character at a
+            # time. With combining marks, the characters they see could
+            # depend on the order (e.g. if the text is NFC-normalized), so
+            # those strings aren't memoized by character set.
+            if not any(map(unicodedata.combining, charset)):
+                if len(by_charset) >= self.charset_maxsize:
+                    by_charset.clear()
+                by_charset[charset] = name, standard, transliteration_tokens
         foreign_tokens = any(
             map(line.has, ("english_y", "foreign", "yiddish_ending"))
         )
-        transliteration_tokens = line.has("transliteration")
-
-        def input_info(standard):
-            return InputInfo(standard, foreign_tokens, transliteration_tokens)
+        info = InputInfo(standard, foreign_tokens, transliteration_tokens)
+        return name, info
 
+    @staticmethod
+    def _pick_standard(line):
+        has_old, has_new, only_new, only_pi, only_old, ascii_letters = map(
+            line.has,
+            ("old", "new", "only_new", "only_pi", "only_old", "ascii_letters"),
+        )
         if only_new:
-            return self.decoders.new, input_info(Standard.new)
+            return "new", Standard.new
         if only_pi:
-            return self.decoders.pi, input_info(Standard.pi)
+            return "pi", Standard.pi
         if only_old:
-            return self.decoders.old, input_info(Standard.old)
+            return "old", Standard.old
         if has_new:
             if has_old:
-                return self.decoders.old, input_info(Standard.unknown)
-            return self.decoders.new, input_info(Standard.new)
+                return "old", Standard.unknown
+            return "new", Standard.new
         if not ascii_letters:
-            return self.decoders.old, input_info(Standard.not_latin)
-        return self.decoders.old, input_info(Standard.unknown)
+            return "old", Standard.not_latin
+        return "old", Standard.unknown
 
+    def pickdecoders(self, strings):
+        """pickdecoder for each of a batch of strings. Returns a list of
+        (decoder, InputInfo) and a Counter of the Standards detected in the
+        batch, by name.
+        """
+        picks = [self.pickdecoder(string) for string in strings]
+        return picks, collections.Counter(i.standard.name for _, i in picks)
+
+    @timed("getchunks")
     def getchunks(self, string: str):
         decoder, input_info = self.pickdecoder(string)
         return decoder.make_chunks(string), input_info
 
+    @timed("usecache")
     def usecache(self, chunks, **kwargs):
         from . import cacheutils as cu
 
         decoder = chunks.decoder
         loc, phon = self.caches.loc, self.caches.phon
         words = []
+        inst = self.instruments
+        if inst is None:
+            match_cached = cu.match_cached
+        else:
+            match_cached = inst.timed_func("match_cached", cu.match_cached)
 
         fully_converted = True
         all_cached = True
         # all_singular = True
         all_recognized = True
         for chunk in chunks:
-            rlist, match_info = cu.match_cached(
+            rlist, match_info = match_cached(
                 chunk, decoder, loc, phon, **kwargs
             )
             words.append(rlist)
+            if inst is not None and match_info.candidate:
+                inst.count(
+                    "cache_hits" if match_info.cached else "cache_misses"
+                )
             if fully_converted:
                 if not filters.Line(str(rlist[0])).has("only_heb"):
                     fully_converted = False
@@ -219,6 +389,31 @@ class Session:
             fully_converted, all_cached, all_recognized
         )
 
+    def run_async(self, func, *args, **kwargs):
+        """run ``func(*args, **kwargs)`` in the session's executor and
+        return an awaitable for the result, so the event loop isn't blocked
+        by decoding or cache lookups. The database connection and the
+        decoders' caches aren't safe to share between threads, so a session
+        should only be used from one thread at a time; with the default
+        executor, everything runs in the same worker thread.
+        """
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.executor = ThreadPoolExecutor(
+                1, thread_name_prefix="arc-session"
+            )
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def getchunks_async(self, string: str):
+        return await self.run_async(self.getchunks, string)
+
+    async def usecache_async(self, chunks, **kwargs):
+        return await self.run_async(self.usecache, chunks, **kwargs)
+
     # NLI stuff
     def add_core(self, name):
 
@@ -233,6 +428,24 @@ class Session:
             core = self.cores[name] = CoreType(
                 self.config.solr_url + "/" + name
             )
+            core.instruments = self.instruments
+        return core
+
+    def add_local_core(self, name, path):
+        """add an in-memory stand-in for an NLI core, for running without
+        Solr. ``path`` is a MARC XML file or a file with one Solr document
+        per line, as written by ``solrdocgen``. Queries on it are
+        synchronous, even in asynchronous sessions.
+        """
+        from .nlitools import solrmarc
+
+        path = Path(path).expanduser()
+        if path.suffix == ".xml":
+            core = solrmarc.LocalNliCore.from_marcxml(str(path))
+        else:
+            core = solrmarc.LocalNliCore.from_jsonl(path)
+        core.instruments = self.instruments
+        self.cores[name] = core
         return core
 
     def add_cores(self, names):
@@ -244,6 +457,40 @@ class Session:
         out = self.termdict = self.config.get_term_counts()
         return out
 
+    def add_spellchecker(self, backend=None, path=None, warm=False):
+        """set up the memoizing spell checker used by the decoders and
+        ``usecache``. Uses Hspell unless another backend is given. Results
+        are persisted to ``path`` (or the ``spelling_cache`` path in the user
+        config) when ``self.spellchecker.save()`` is called. If ``warm`` is
+        true, words from the term dictionary are checked up front.
+        """
+        if self.spellchecker:
+            return self.spellchecker
+        from . import spelling
+
+        path = path or self.config.user_conf.get("spelling_cache")
+        checker = self.spellchecker = spelling.set_checker(
+            spelling.SpellChecker(backend, path=path)
+        )
+        if warm:
+            checker.warm(self.add_termdict())
+        return checker
+
+    def add_authorities(self, picanames, maxsize=2 ** 14, path=None):
+        """set up the cache for names from authority records used by
+        ``picaqueries.getnamecomponents``. ``picanames`` maps PPNs to
+        authority records. Parsed names are persisted to ``path`` (or the
+        ``authority_cache`` path in the user config) when
+        ``self.authorities.save()`` is called.
+        """
+        if self.authorities:
+            return self.authorities
+        from .picaqueries import AuthorityCache
+
+        path = path or self.config.user_conf.get("authority_cache")
+        self.authorities = AuthorityCache(picanames, maxsize, path)
+        return self.authorities
+
 
 def mk_default(resources="resources"):
     import deromanize.config
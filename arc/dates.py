@@ -1,31 +1,44 @@
 """
 Some functions for dealing with Hebrew dates.
 """
+import functools
+import re
 import string
 import deromanize
 import hebrew_numbers
 
 num_strip = deromanize.stripper_factory(string.digits)
+# date strings are split on whitespace, hyphens and slashes.
+date_tokens = re.compile(r"[^\s/-]+")
+
+
+@functools.lru_cache(maxsize=2 ** 14)
+def token2year(token):
+    _, d, _ = num_strip(token)
+    try:
+        return int(d)
+    except ValueError:
+        return hebrew_numbers.gematria_to_int(token)
+
+
+@functools.lru_cache(maxsize=2 ** 14)
+def parse_date(datestring):
+    """tuple of the numbers in a date string. Gregorian years are digits,
+    Hebrew years are usually letters.
+    """
+    years = []
+    for token in date_tokens.findall(datestring):
+        token = token.strip(string.punctuation)
+        if token:
+            years.append(token2year(token))
+    return tuple(years)
 
 
 def date2years(datestring):
-    probably_dates = (
-        split.strip(string.punctuation)
-        for part in datestring.split()
-        for piece in part.split("-")
-        for split in piece.split("/")
-    )
-    for date in probably_dates:
-        if not date:
-            continue
-        try:
-            _, d, _ = num_strip(date)
-            yield int(d)
-        except ValueError:
-            yield hebrew_numbers.gematria_to_int(date)
+    yield from parse_date(datestring)
 
 
-def yearnorm(year):
+def _yearnorm(year):
     if 6000 < year or year < 32:
         return ()
     if year < 1000:
@@ -35,3 +48,26 @@ def yearnorm(year):
         return (year, newyear, newyear - 1)
     else:
         return (year,)
+
+
+# yearnorm for every number it doesn't reject.
+NORMALIZED = {year: _yearnorm(year) for year in range(32, 6001)}
+
+
+def yearnorm(year):
+    """all the years a number from a date string could stand for: Hebrew
+    years (with or without the thousands) are converted to the two
+    Gregorian years they overlap with.
+    """
+    return NORMALIZED.get(year, ())
+
+
+@functools.lru_cache(maxsize=2 ** 14)
+def normyears(datestring):
+    """frozenset of the normalized years for all numbers in a date string.
+    Same as collecting yearnorm() for everything from date2years().
+    """
+    years = set()
+    for year in parse_date(datestring):
+        years.update(NORMALIZED.get(year, ()))
+    return frozenset(years)
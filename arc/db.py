@@ -83,6 +83,43 @@ class ArcDB(pica_parse.db.PicaDB):
         http://docs.sqlalchemy.org/en/latest/core/engines.html#database-urls
         """
         super().__init__(sqlachemy_url)
+        self.prefetched = {}
+
+    def __getitem__(self, key):
+        try:
+            return self.prefetched[key]
+        except (KeyError, TypeError):
+            return super().__getitem__(key)
+
+    def prefetch(self, ppns, fields=("021A",), chunksize=500):
+        """load fields for a batch of records, with one query for every
+        ``chunksize`` PPNs. Until clear_prefetched() is called, lookups with
+        ``db[ppn, field]`` for these are answered from memory.
+        """
+        ppns = list(dict.fromkeys(ppns))
+        fields = list(fields)
+        prefetched = self.prefetched
+        for ppn in ppns:
+            for field in fields:
+                prefetched[ppn, field] = []
+        for i in range(0, len(ppns), chunksize):
+            # fields in the order they were stored, so the first matching
+            # field of a record is always the same one.
+            query = (
+                self.session.query(Field.ppn, Field.field, Field.content)
+                .filter(
+                    Field.ppn.in_(ppns[i : i + chunksize]),
+                    Field.field.in_(fields),
+                )
+                .order_by(*Field.__table__.primary_key)
+            )
+            for ppn, field, content in query:
+                prefetched[ppn, field].append(
+                    pica_parse.PicaField(field, content, "ƒ")
+                )
+
+    def clear_prefetched(self):
+        self.prefetched.clear()
 
     def add_input(self, ppn, generated, submitted):
         words, errors, badwords = diff_output(generated, submitted)
@@ -102,12 +139,18 @@ class ArcDB(pica_parse.db.PicaDB):
             )
 
     def get_title(self, ppn):
-        fields = self[ppn, "021A"]
-        for field in fields:
+        """the romanized title of a record, or None if it has no romanized
+        021A field.
+        """
+        for field in self[ppn, "021A"]:
             lang = field.get("U")
             if lang is None or lang == "Latn":
-                maintitle = field.get("a")
                 break
+        else:
+            return None
+        maintitle = field.get("a")
+        if maintitle is None:
+            return None
         subtitle = field.get("d")
         if subtitle:
             title = maintitle + " ։ " + subtitle
@@ -115,6 +158,53 @@ class ArcDB(pica_parse.db.PicaDB):
             title = maintitle
         return title
 
+    def get_titles(self, ppns):
+        """titles for a batch of PPNs, as a dictionary. The title fields are
+        prefetched, so there is no query per record. Records without a
+        romanized title map to None.
+        """
+        ppns = list(ppns)
+        # titles prefetched by the caller are used and left alone.
+        added = [
+            ppn
+            for ppn in dict.fromkeys(ppns)
+            if (ppn, "021A") not in self.prefetched
+        ]
+        self.prefetch(added, ["021A"])
+        try:
+            return {ppn: self.get_title(ppn) for ppn in ppns}
+        finally:
+            for ppn in added:
+                self.prefetched.pop((ppn, "021A"), None)
+
+    def verified_pairs(self, chunksize=500):
+        """(romanized title, corrected Hebrew) for each checked record with
+        a correction, the latest one if it was checked more than once.
+        Titles are fetched ``chunksize`` records at a time.
+        """
+        query = (
+            self.session.query(Checked.ppn, Checked.corrected)
+            .filter(Checked.corrected.isnot(None))
+            .order_by(Checked.id)
+        )
+        corrected = dict(query)
+        ppns = list(corrected)
+        for i in range(0, len(ppns), chunksize):
+            titles = self.get_titles(ppns[i : i + chunksize])
+            for ppn, title in titles.items():
+                if title:
+                    yield title, corrected[ppn]
+
+    def checked_titles(self, chunksize=500):
+        """the romanized title of each record that has been checked. Titles
+        are fetched ``chunksize`` records at a time.
+        """
+        ppns = [ppn for ppn, in self.session.query(Checked.ppn).distinct()]
+        for i in range(0, len(ppns), chunksize):
+            for title in self.get_titles(ppns[i : i + chunksize]).values():
+                if title:
+                    yield title
+
     def audit(self):
         query = (
             self.session.query(Change, Field)
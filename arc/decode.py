@@ -18,23 +18,20 @@
 # this file under either the MPL or the EUPL.
 import collections
 import re
+import sys
 import unicodedata
+from collections import abc
 import deromanize as dr
 import libaaron
 from deromanize import trees, keygenerator as kg, get_self_rep
 from . import cacheutils
+from . import spelling
+from .candidates import Candidates, StringTable
 from .matchprefix import prefixmatcherfactory
 import hebrew_numbers
 
 matchprefix = prefixmatcherfactory()
 
-try:
-    from HspellPy import Hspell
-
-    hspell = Hspell(linguistics=True)
-except ImportError:
-    hspell = None
-
 
 class DecoderMismatch(Exception):
     pass
@@ -58,9 +55,13 @@ class Decoder:
         fix_numerals=False,
         spellcheck=False,
         fix_k=False,
-        name=None
+        name=None,
+        keys=None
     ):
-        """Initialize with a deserialized profile from deromanize"""
+        """Initialize with a deserialized profile from deromanize. ``keys``
+        are the expanded keys of the profile if they've been built already
+        (see arc.profiles).
+        """
         self.name = name
         self.profile = profile
         self.joined_prefix = trees.Trie(
@@ -68,14 +69,16 @@ class Decoder:
         )
         self.prefix_vowels = set(profile["prefix_vowels"]) | {""}
         self.gem_prefix = trees.Trie({i: i for i in profile["gem_prefixes"]})
-        self.keys = dr.KeyGenerator(profile)
+        self.keys = dr.KeyGenerator(profile) if keys is None else keys
         self.num = fix_numerals
         self.sp = spellcheck
-        self.w_kw = {
-            "decoder": self,
-            "fix_numerals": self.num,
-            "spellcheck": self.sp,
-        }
+        # decoded replists shared by all Words with the same stripped token.
+        self.token_cache = {}
+        self.prefix_cache = {}
+        self.hyphen_cache = {}
+        self.token_cache_size = 2 ** 16
+        # Hebrew strings read from Candidates
+        self.strings = StringTable(self.token_cache_size)
         if strip_func:
             self.strip = strip_func
         else:
@@ -123,7 +126,7 @@ class Decoder:
         remixed = Chunks(self)
         for chunk in raw_chunks:
             if chunk == ["", ""]:
-                remixed.append(Chunk([Word("-", **self.w_kw)]))
+                remixed.append(Chunk([Word("-", self)]))
                 continue
             new_chunk = Chunk()
             for i, inner in enumerate(chunk[:-1]):
@@ -131,14 +134,14 @@ class Decoder:
                 if preparts:
                     new_chunk.extend(Prefix(p, self) for p in preparts)
                 else:
-                    new_chunk.append(Word(inner, **self.w_kw))
+                    new_chunk.append(Word(inner, self))
                     remixed.extend([new_chunk, maqef])
                     new_chunk = Chunk()
             if new_chunk:
-                new_chunk.append(Word(chunk[-1], **self.w_kw))
+                new_chunk.append(Word(chunk[-1], self))
                 remixed.append(new_chunk)
             else:
-                remixed.append(Chunk([Word(chunk[-1], **self.w_kw)]))
+                remixed.append(Chunk([Word(chunk[-1], self)]))
         return remixed
 
     def checkprefix(self, i, inner, chunk):
@@ -150,6 +153,51 @@ class Decoder:
             return None
         return parts
 
+    def cache_token(self, cache, token, replist):
+        """add a decoded replist to one of the token caches. The oldest entry
+        is dropped when the cache is full. Replists in the caches are shared
+        between Words, so they must not be modified after this.
+        """
+        if len(cache) >= self.token_cache_size:
+            del cache[next(iter(cache))]
+        cache[token] = replist
+        return replist
+
+    def warm(self, tokens):
+        """decode stripped tokens (as in ``Word.split[1]``) into the token
+        cache ahead of time, until it is full. Returns the number of tokens
+        in the cache afterwards.
+        """
+        cache = self.token_cache
+        for token in tokens:
+            if len(cache) >= self.token_cache_size:
+                break
+            if token not in cache:
+                Word(token, self).stripped_heb
+        return len(cache)
+
+    def clear_caches(self):
+        """forget all decoded tokens and LOC/ALA forms"""
+        self.token_cache.clear()
+        self.prefix_cache.clear()
+        self.hyphen_cache.clear()
+        self.strings.clear()
+        self.get_loc.cache.clear()
+        self.get_loc.pairs.clear()
+
+    def hyphenated(self, token, replist):
+        """hyphenate(replist), shared between Words if replist is the one in
+        the token cache.
+        """
+        if self.token_cache.get(token) is not replist:
+            return hyphenate(replist)
+        try:
+            return self.hyphen_cache[token]
+        except KeyError:
+            return self.cache_token(
+                self.hyphen_cache, token, hyphenate(replist)
+            )
+
 
 def fix_initial_article(line):
     if line.startswith("ha"):
@@ -221,14 +269,16 @@ def remove_combining(line):
 
 
 class Word:
-    __slots__ = "word", "split", "keys", "num", "sp", "_stripped_heb", "_heb"
+    __slots__ = "word", "split", "decoder", "_stripped_heb", "_heb"
 
-    def __init__(self, word, decoder, fix_numerals=False, spellcheck=False):
-        self.word = word
-        self.split = decoder.strip(word)
-        self.keys = decoder.keys
-        self.num = fix_numerals
-        self.sp = spellcheck
+    def __init__(self, word, decoder):
+        self.word = sys.intern(str(word))
+        self.split = tuple(map(sys.intern, decoder.strip(word)))
+        self.decoder = decoder
+
+    @property
+    def keys(self):
+        return self.decoder.keys
 
     @property
     def stripped_heb(self):
@@ -236,20 +286,28 @@ class Word:
             return self._stripped_heb
         except AttributeError:
             pass
+        decoder = self.decoder
         front, rom, back = self.split
         try:
-            word = coredecode(self.keys, rom, self.sp)
+            word = decoder.token_cache[rom]
         except KeyError:
-            if self.num:
-                try:
-                    word = fix_numerals(rom)
-                except ValueError:
+            try:
+                word = decoder.cache_token(
+                    decoder.token_cache,
+                    rom,
+                    coredecode(decoder.keys, rom, decoder.sp),
+                )
+            except KeyError:
+                if decoder.num:
+                    try:
+                        word = fix_numerals(rom)
+                    except ValueError:
+                        word = get_self_rep(self.word)
+                else:
                     word = get_self_rep(self.word)
-            else:
-                word = get_self_rep(self.word)
 
-        except IndexError:
-            return
+            except IndexError:
+                return
         self._stripped_heb = word
         return word
 
@@ -275,23 +333,67 @@ class Word:
 
 
 class Prefix(Word):
+    __slots__ = ()
+
     @libaaron.cached
     def stripped_heb(self):
+        decoder = self.decoder
         front, rom, back = self.split
-        word, remainder = self.keys["front"].getpart(rom)
+        try:
+            return decoder.prefix_cache[rom]
+        except KeyError:
+            pass
+        word, remainder = decoder.keys["front"].getpart(rom)
         # work on a copy because we're going to modify the object's state
         word = word.copy()
         rep = dr.Replacement
         key = word.key + remainder[0:1]
         w = word[0]
         word.data = [rep.new(w.weight, str(w), key) + rep.new(0, "", "-")]
-        return word
+        return decoder.cache_token(decoder.prefix_cache, rom, word)
 
     def __repr__(self):
         return "Prefix({!r})".format(self.word)
 
 
-class LinkedReplist(collections.UserList):
+class SlottedList(abc.MutableSequence):
+    """list wrapper like collections.UserList, but with __slots__, so
+    instances don't need a __dict__. Slicing returns a plain list.
+    """
+
+    __slots__ = ("data",)
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __setitem__(self, i, value):
+        self.data[i] = value
+
+    def __delitem__(self, i):
+        del self.data[i]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, SlottedList):
+            other = other.data
+        return self.data == other
+
+    def insert(self, i, value):
+        self.data.insert(i, value)
+
+    def append(self, value):
+        self.data.append(value)
+
+    def extend(self, values):
+        self.data.extend(values)
+
+
+class LinkedReplist(SlottedList):
     __slots__ = "data", "linked", "_head_dict"
 
     def __init__(self, *linked):
@@ -330,10 +432,11 @@ class LinkedReplist(collections.UserList):
         return type(self)(*[l.copy() for l in self.linked])
 
 
-class Chunk(collections.UserList):
+class Chunk(SlottedList):
+    __slots__ = "_stripped_heb", "_heb", "_linked_heb", "_candidates"
+
     def __init__(self, parts=None):
         self.data = parts or []
-        self.reorder = None
 
     @property
     def rom(self):
@@ -350,6 +453,24 @@ class Chunk(collections.UserList):
             he = hyphenate(he)
         return prefix + he
 
+    def get_candidates(self, strip=False):
+        """like replist_gen, but returns compact Candidates. The replists of
+        the parts aren't copied or combined.
+        """
+        parts = [i.stripped_heb if strip else i.heb for i in self.data[:-1]]
+        base = self.base
+        he = base.stripped_heb if strip else base.heb
+        if parts:
+            he = base.decoder.hyphenated(base.split[1], he)
+        else:
+            parts = [dr.get_empty_replist()]
+        keyparts = ()
+        for part in parts:
+            keyparts += part[0].keyparts
+        return Candidates.product(
+            parts + [he], keyparts + he.keyparts, base.decoder.strings
+        )
+
     def prefix_gen(self, strip=False):
         return dr.add_rlists(
             [i.stripped_heb if strip else i.heb for i in self.data[:-1]]
@@ -363,7 +484,11 @@ class Chunk(collections.UserList):
         return self.data[-1]
 
     def basemerge(
-        self, rebase: dr.ReplacementList, with_prefix=False, gershayim=True
+        self,
+        rebase: dr.ReplacementList,
+        with_prefix=False,
+        gershayim=True,
+        compact=False,
     ):
         if gershayim:
             rebase = dr.fix_gershayim_late(rebase)
@@ -379,20 +504,30 @@ class Chunk(collections.UserList):
         if prefix and maybe_hyphenate:
             rebase = hyphenate(rebase)
         end = dr.get_self_rep(base.split[2])
+        if compact:
+            return Candidates.product(
+                (prefix, rebase, end), table=base.decoder.strings
+            )
         return dr.add_rlists((prefix, rebase, end))
 
-    @libaaron.reify
+    @libaaron.cached
     def stripped_heb(self):
         return self.replist_gen(strip=True)
 
-    @libaaron.reify
+    @libaaron.cached
     def heb(self):
         return self.replist_gen(strip=False)
 
-    @libaaron.reify
+    @libaaron.cached
+    def candidates(self):
+        return self.get_candidates()
+
+    @libaaron.cached
     def linked_heb(self):
+        # the base replist is shared through the decoder's token cache, and
+        # LinkedReplist modifies its replists when it's sorted.
         return LinkedReplist(
-            self.stripped_heb, self.heb, self[-1].stripped_heb
+            self.stripped_heb, self.heb, self[-1].stripped_heb.copy()
         )
 
     def groups(self):
@@ -429,7 +564,9 @@ def hyphenate(rlist):
     return rlist
 
 
-class Chunks(collections.UserList):
+class Chunks(SlottedList):
+    __slots__ = "decoder", "_stripped_heb", "_heb", "_linked_heb"
+
     def __init__(self, decoder, chunks=None):
         self.data = chunks or []
         self.decoder = decoder
@@ -441,8 +578,8 @@ class Chunks(collections.UserList):
         if self.decoder is not other.decoder:
             raise DecoderMismatch
         new = Chunks(self.decoder, self.data + other.data)
-        new.stripped_heb = self.stripped_heb + other.stripped_heb
-        new.heb = self.heb + other.heb
+        new._stripped_heb = self.stripped_heb + other.stripped_heb
+        new._heb = self.heb + other.heb
         return new
 
     def get_word_chunks(self):
@@ -474,15 +611,38 @@ class Chunks(collections.UserList):
                 hebz.append(get_self_rep(chunk))
         return hebz
 
-    @libaaron.reify
+    def get_candidates(self, strip=False):
+        """like get_heb, but with Candidates instead of replists."""
+        table = self.decoder.strings
+        out = []
+        for chunk in self:
+            if isinstance(chunk, Chunk):
+                if self.decoder.sp == "double":
+                    replist = chunk.stripped_heb if strip else chunk.heb
+                    double_check_spelling(replist, self.decoder.strip)
+                    out.append(Candidates.from_replist(replist, table))
+                elif strip:
+                    out.append(chunk.get_candidates(strip=True))
+                else:
+                    out.append(chunk.candidates)
+            elif chunk is maqef:
+                if not strip:
+                    out.append(Candidates.from_replist(chunk, table))
+            else:
+                out.append(
+                    Candidates.from_replist(get_self_rep(chunk), table)
+                )
+        return out
+
+    @libaaron.cached
     def stripped_heb(self):
         return self.get_heb(strip=True)
 
-    @libaaron.reify
+    @libaaron.cached
     def heb(self):
         return self.get_heb(strip=False)
 
-    @libaaron.reify
+    @libaaron.cached
     def linked_heb(self):
         return self.get_heb(strip=True, link=True)
 
@@ -553,23 +713,23 @@ def fix_numerals(int_str, gershayim=False):
         return kg.ReplacementList.new(int_str, [int_str, front + heb + back])
 
 
-def check_spelling(replist):
+def check_spelling(replist, checker=None):
     # side effects
+    known = (checker or spelling.get_checker()).check_many(
+        map(str, replist), linginfo=True
+    )
     for r in replist:
-        heb = str(r)
-        if not (hspell.check_word(heb) and hspell.linginfo(heb)):
+        if not known[str(r)]:
             r.weight += 200
 
 
-def double_check_spelling(replist, strip_func):
+def double_check_spelling(replist, strip_func, checker=None):
+    checker = checker or spelling.get_checker()
     for rep in replist:
         if rep.weight < 0:
             _, core, _ = strip_func(str(rep))
-            try:
-                if not hspell.check_word(core):
-                    rep.weight += 1000
-            except UnicodeEncodeError:
-                pass
+            if checker.check(core) is False:
+                rep.weight += 1000
         else:
             break
     replist.sort()
@@ -578,6 +738,19 @@ def double_check_spelling(replist, strip_func):
 num_strip = dr.stripper_factory(("0123456789",))
 
 
+def double_junker(word):
+    """split anything that isn't a letter or a digit off both ends of a word.
+    Returns (front junk, word, back junk), like the functions from
+    stripper_factory, but works for any script.
+    """
+    start, end = 0, len(word)
+    while start < end and not word[start].isalnum():
+        start += 1
+    while end > start and not word[end - 1].isalnum():
+        end -= 1
+    return word[:start], word[start:end], word[end:]
+
+
 class FakeReplacementList(kg.ReplacementList):
     pass
 
@@ -64,6 +64,14 @@ NON_HEB = r"""(?x)
     \bth|au|ao|ae|aa|oe|pf|
     ou|eu|ue|oo|ee|uo|eo|io|oi|ui|iu|[üäëöïáéàèíßçcx]
     """
+# parts of NON_HEB which can be tested without the regex. They're tests on
+# the Line like "foreign" (see foreign_chars, foreign_words), so they see the
+# same data, and a line which has either one has "foreign" too.
+NON_HEB_CHARS = frozenset("üäëöïáéàèíßçcx")
+NON_HEB_WORDS = frozenset(
+    "a der di des de dos das dem in zi von zî fun fir fûn il of and und un "
+    "tsu zu ṣu".split()
+)
 YIDDISH_ENDING = "[" + "".join(CONSONANT_SET - {"y"}) + r"]n(\s|$)"
 ENGLISH_Y = "[" + CONSONANTS + r"]y(\s|$)"
 ARABIC_ARTICLE = r"(\W|^)al-[^p]"
@@ -81,6 +89,7 @@ fs.haschars(HEB_CHARS, "heb")
 fs.haschars(SHORT_U, "short_u")
 fs.haschars(DIACRITIC_VOWELS, "diacritic_vowels")
 fs.haschars(string.ascii_letters, "ascii_letters")
+fs.haschars(NON_HEB_CHARS, "foreign_chars")
 
 fs.hascluster(NEW_DIGRAPHS, "new_digraphs")
 fs.hascluster(UNDIGRAPHS, "undigraphs")
@@ -96,6 +105,11 @@ fs.hasregex(ARABIC_ARTICLE, "arabic_article")
 fs.hasregex(ENGLISH_Y, "english_y")
 
 
+@fs.register
+def foreign_words(line):
+    return not NON_HEB_WORDS.isdisjoint(line.data.split())
+
+
 @fs.register
 def inner_sing_quote(line):
     return "'" in line.data and not SING_QUOTE.search(line.data)
@@ -0,0 +1,179 @@
+"""
+Opt-in timers and counters for the hot paths of a conversion run.
+
+Nothing here is used unless Session.instrument() is called. While it's off,
+methods wrapped with ``timed`` only check whether their object has instruments
+attached, so the overhead is one extra function call.
+"""
+import collections
+import contextlib
+import functools
+import os
+import tempfile
+import time
+from pathlib import Path
+
+perf_counter = time.perf_counter
+
+
+def timed(stage):
+    """decorator for methods of objects with an ``instruments`` attribute.
+    Time spent in the method is recorded under ``stage`` if the attribute
+    isn't None.
+    """
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instruments = self.instruments
+            if instruments is None:
+                return method(self, *args, **kwargs)
+            start = perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                instruments.add_time(stage, perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class Instruments:
+    """collects time spent and number of calls per stage, as well as
+    arbitrary event counters.
+    """
+
+    def __init__(self, interval=None, prometheus_path=None, stream=None):
+        """
+        - interval: seconds between automatic reports. No automatic
+          reports if None.
+        - prometheus_path: file to write metrics to in the Prometheus text
+          format (e.g. for the node exporter's textfile collector).
+        - stream: file-like object for human-readable summaries.
+        """
+        self.times = collections.Counter()
+        self.calls = collections.Counter()
+        self.counts = collections.Counter()
+        self.collectors = []
+        self.interval = interval
+        self.prometheus_path = (
+            Path(prometheus_path).expanduser() if prometheus_path else None
+        )
+        self.stream = stream
+        self.started = self.last_report = time.monotonic()
+
+    def add_time(self, stage, seconds):
+        self.times[stage] += seconds
+        self.calls[stage] += 1
+        if self.interval is not None:
+            self.tick()
+
+    def count(self, event, n=1):
+        self.counts[event] += n
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def timed_func(self, stage, func):
+        """wrap a function so calls to it are recorded under ``stage``"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_time(stage, perf_counter() - start)
+
+        return wrapper
+
+    async def timed_await(self, stage, awaitable):
+        start = perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.add_time(stage, perf_counter() - start)
+
+    def add_collector(self, func):
+        """register a function returning a dictionary of additional counters
+        which are read when metrics are exported.
+        """
+        self.collectors.append(func)
+
+    def all_counts(self):
+        counts = collections.Counter(self.counts)
+        for collect in self.collectors:
+            counts.update(collect())
+        return counts
+
+    def reset(self):
+        self.times.clear()
+        self.calls.clear()
+        self.counts.clear()
+        self.started = self.last_report = time.monotonic()
+
+    def tick(self):
+        """report if the interval has passed since the last report."""
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self):
+        if self.stream:
+            print(self.summary(), file=self.stream)
+        if self.prometheus_path:
+            self.write_prometheus()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        lines = ["# arc stats after {:.1f}s".format(elapsed)]
+        for stage, total in self.times.most_common():
+            calls = self.calls[stage]
+            lines.append(
+                "{:15} {:>10} calls {:10.3f}s {:10.3f}ms/call".format(
+                    stage, calls, total, total / calls * 1000
+                )
+            )
+        for event, n in sorted(self.all_counts().items()):
+            lines.append("{:15} {:>10}".format(event, n))
+        return "\n".join(lines)
+
+    def prometheus(self, prefix="arc"):
+        """metrics in the Prometheus text exposition format"""
+        metrics = (
+            (
+                "stage_seconds_total",
+                "time spent in each stage",
+                "stage",
+                self.times,
+            ),
+            ("stage_calls_total", "calls to each stage", "stage", self.calls),
+            ("events_total", "event counters", "event", self.all_counts()),
+        )
+        lines = []
+        for name, help_, label, values in metrics:
+            name = prefix + "_" + name
+            lines.append("# HELP {} {}".format(name, help_))
+            lines.append("# TYPE {} counter".format(name))
+            for key, value in sorted(values.items()):
+                lines.append(
+                    '{}{{{}="{}"}} {}'.format(name, label, key, value)
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        """write metrics to a file. The file is replaced atomically so
+        scrapers never see a partial file.
+        """
+        path = Path(path or self.prometheus_path)
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix=".tmp")
+        with open(fd, "w") as fh:
+            fh.write(self.prometheus())
+        os.replace(tmp, str(path))
@@ -0,0 +1,549 @@
+"""
+An in-process stand-in for a Solr core, for offline runs, tests and
+benchmarks.
+
+LocalCore keeps documents (e.g. from marcxml2solr) in memory with an inverted
+index over their text fields. run_query() understands the subset of the
+Lucene query syntax that arc generates (see solrtools.join and friends):
+fields, parenthesized groups, AND/OR/NOT, quoted phrases, escapes and fuzzy
+terms with ``~``, and returns results in the same shape as SolrCore. serve()
+makes cores available over HTTP, for testing SolrCore itself.
+
+Relevance is only approximated. Terms are scored by inverse document
+frequency, fuzzy matches count for less than exact ones, and fuzzy matching
+uses Levenshtein distance where Lucene uses Damerau-Levenshtein.
+"""
+import argparse
+import collections
+import http.server
+import json
+import math
+import re
+import time
+import urllib.parse
+from pathlib import Path
+from typing import Any, List, NamedTuple, Optional, Tuple
+import Levenshtein
+from .solrtools import QueryError, EmptyQuery, grouped_request, ungroup
+
+# roughly what an ICU tokenizer does with Hebrew: gershayim and geresh
+# between letters are part of the word.
+WORD = re.compile(r"\w+(?:[\"'״׳]\w+)*")
+# Lucene never expands fuzzy terms by more than two edits.
+MAX_EDITS = 2
+MUST, SHOULD, MUST_NOT = "must", "should", "must_not"
+
+
+def analyze(text):
+    return WORD.findall(text.lower())
+
+
+class Term(NamedTuple):
+    field: Optional[str]
+    text: str
+    edits: int
+
+
+class Phrase(NamedTuple):
+    field: Optional[str]
+    text: str
+
+
+class Bool(NamedTuple):
+    # (occur, query) pairs
+    clauses: List[Tuple[str, Any]]
+
+
+_query_tokens = re.compile(
+    r"""
+    (?P<space>\s+)
+    | (?P<open>\()
+    | (?P<close>\))
+    | (?P<phrase>"(?:\\.|[^"\\])*")(?:~\d*)?
+    | (?P<term>(?:\\.|[^\s()"\\])+)
+    """,
+    re.VERBOSE,
+)
+_unescape = re.compile(r"\\(.)")
+_fuzzy = re.compile(r"(?<!\\)~([\d.]*)$")
+_field = re.compile(r"^((?:\\.|[^:\\])+)(?<!\\):")
+
+
+def _max_edits(spec):
+    if not spec:
+        return MAX_EDITS
+    edits = float(spec)
+    # old-style minimum similarity (e.g. ~0.8) instead of an edit count.
+    if edits < 1:
+        return MAX_EDITS
+    return min(int(edits), MAX_EDITS)
+
+
+def tokenize_query(query):
+    pos = 0
+    while pos < len(query):
+        match = _query_tokens.match(query, pos)
+        if not match:
+            raise QueryError("can't parse query at %d" % pos, query)
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "space":
+            continue
+        if kind == "phrase":
+            yield kind, match.group(kind)[1:-1]
+            continue
+        text = match.group(kind)
+        if kind != "term":
+            yield kind, text
+            continue
+        field = _field.match(text)
+        if field:
+            yield "field", _unescape.sub(r"\1", field.group(1))
+            text = text[field.end() :]
+            if not text:
+                continue
+        if text in ("AND", "&&", "OR", "||", "NOT"):
+            yield "op", {"&&": "AND", "||": "OR"}.get(text, text)
+            continue
+        fuzzy = _fuzzy.search(text)
+        if fuzzy:
+            edits = _max_edits(fuzzy.group(1))
+            text = text[: fuzzy.start()]
+        else:
+            edits = 0
+        yield "term", (_unescape.sub(r"\1", text), edits)
+
+
+def parse_query(query, default_field=None):
+    """parse a Lucene query string into nested Bool, Term and Phrase
+    tuples. Terms without a field get ``default_field`` (None means all
+    fields).
+    """
+    tokens = list(tokenize_query(query))
+    if not tokens:
+        raise EmptyQuery("No search terms", query)
+    parsed, pos = _parse_bool(tokens, 0, default_field, query)
+    if pos != len(tokens):
+        raise QueryError("unbalanced parentheses", query)
+    return parsed
+
+
+def _parse_bool(tokens, pos, field, query):
+    clauses = []
+    conjunction = False
+    negate = False
+    while pos < len(tokens):
+        kind, value = tokens[pos]
+        if kind == "close":
+            break
+        pos += 1
+        if kind == "op":
+            if value == "AND":
+                conjunction = True
+                if clauses and clauses[-1][0] == SHOULD:
+                    clauses[-1] = (MUST, clauses[-1][1])
+            elif value == "NOT":
+                negate = True
+            continue
+        clause_field = field
+        if kind == "field":
+            clause_field = value
+            try:
+                kind, value = tokens[pos]
+            except IndexError:
+                raise QueryError("field without a query", query)
+            pos += 1
+        if kind == "open":
+            clause, pos = _parse_bool(tokens, pos, clause_field, query)
+            if pos >= len(tokens):
+                raise QueryError("unbalanced parentheses", query)
+            pos += 1
+        elif kind == "phrase":
+            clause = Phrase(clause_field, _unescape.sub(r"\1", value))
+        elif kind == "term":
+            clause = Term(clause_field, *value)
+        else:
+            raise QueryError("unexpected %r" % value, query)
+
+        if negate:
+            occur = MUST_NOT
+        elif conjunction:
+            occur = MUST
+        else:
+            occur = SHOULD
+        clauses.append((occur, clause))
+        conjunction = negate = False
+    return Bool(clauses), pos
+
+
+class LocalCore:
+    """in-memory search over documents, with the same run_query()
+    interface as solrtools.SolrCore.
+    """
+
+    # set to an arc.instrument.Instruments instance to time queries
+    instruments = None
+
+    def __init__(self, docs=(), copy_fields=None, indexed=None):
+        """
+        - docs: iterable of Solr documents (dictionaries of field names to
+          strings or lists of strings).
+        - copy_fields: dictionary of copy field names to the fields copied
+          into them, like Solr's copy fields. Copy fields are stored.
+        - indexed: function which takes a field name and returns True if
+          it should be indexed. By default, fields ending with ``_txt`` and
+          the copy fields are.
+        """
+        self.copy_fields = copy_fields or {}
+        self.indexed = indexed or self._default_indexed
+        self.docs = []
+        self.postings = collections.defaultdict(
+            lambda: collections.defaultdict(list)
+        )
+        self._by_length = {}
+        self._expansions = {}
+        self.add_docs(docs)
+
+    def _default_indexed(self, field):
+        return field.endswith("_txt") or field in self.copy_fields
+
+    @classmethod
+    def from_jsonl(cls, path, **kwargs):
+        """load documents from a file with one JSON document per line, as
+        written by ``solrdocgen``.
+        """
+        with Path(path).open() as fh:
+            return cls(map(json.loads, filter(str.strip, fh)), **kwargs)
+
+    def add_doc(self, doc):
+        if isinstance(doc, list):
+            return self.add_docs(doc)
+        stored = {
+            field: list(value) if isinstance(value, (list, tuple)) else [value]
+            for field, value in doc.items()
+        }
+        for name, sources in self.copy_fields.items():
+            copied = stored.setdefault(name, [])
+            for source in sources:
+                copied.extend(stored.get(source, ()))
+            if not copied:
+                del stored[name]
+
+        doc_id = len(self.docs)
+        self.docs.append(stored)
+        for field, values in stored.items():
+            if not self.indexed(field):
+                continue
+            postings = self.postings[field]
+            for term in set(t for v in values for t in analyze(str(v))):
+                postings[term].append(doc_id)
+        self._by_length.clear()
+        self._expansions.clear()
+        return doc_id
+
+    def add_docs(self, docs):
+        return [self.add_doc(doc) for doc in docs]
+
+    def commit(self):
+        pass
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _fields(self, field):
+        if field is None:
+            return list(self.postings)
+        return [field] if field in self.postings else []
+
+    def expand(self, field, term, edits):
+        """indexed terms in ``field`` within ``edits`` of ``term``, with
+        their distances.
+        """
+        if not edits:
+            return [(term, 0)] if term in self.postings[field] else []
+        key = field, term, edits
+        try:
+            return self._expansions[key]
+        except KeyError:
+            pass
+        try:
+            by_length = self._by_length[field]
+        except KeyError:
+            by_length = self._by_length[field] = collections.defaultdict(
+                list
+            )
+            for indexed in self.postings[field]:
+                by_length[len(indexed)].append(indexed)
+
+        out = []
+        size = len(term)
+        for length in range(size - edits, size + edits + 1):
+            for indexed in by_length.get(length, ()):
+                distance = Levenshtein.distance(
+                    term, indexed, score_cutoff=edits
+                )
+                if distance <= edits:
+                    out.append((indexed, distance))
+        self._expansions[key] = out
+        return out
+
+    def _idf(self, df):
+        return 1 + math.log(len(self.docs) / (df + 1))
+
+    def _search_term(self, query):
+        if query.text == "*" and query.field in (None, "*"):
+            return collections.Counter(dict.fromkeys(range(len(self.docs)), 1))
+        tokens = analyze(query.text)
+        if not tokens:
+            return None
+        scores = collections.Counter()
+        for field in self._fields(query.field):
+            postings = self.postings[field]
+            for token in tokens:
+                for term, distance in self.expand(
+                    field, token, query.edits
+                ):
+                    doc_ids = postings[term]
+                    weight = self._idf(len(doc_ids))
+                    if distance:
+                        weight *= 1 - distance / (len(token) + 1)
+                    for doc_id in doc_ids:
+                        scores[doc_id] += weight
+        return scores
+
+    def _search_phrase(self, query):
+        tokens = analyze(query.text)
+        if not tokens:
+            return None
+        scores = collections.Counter()
+        size = len(tokens)
+        for field in self._fields(query.field):
+            postings = self.postings[field]
+            if any(t not in postings for t in tokens):
+                continue
+            candidates = set(postings[tokens[0]])
+            for token in tokens[1:]:
+                candidates.intersection_update(postings[token])
+            weight = sum(self._idf(len(postings[t])) for t in tokens)
+            for doc_id in candidates:
+                for value in self.docs[doc_id].get(field, ()):
+                    words = analyze(str(value))
+                    if any(
+                        words[i : i + size] == tokens
+                        for i in range(len(words) - size + 1)
+                    ):
+                        scores[doc_id] += weight
+                        break
+        return scores
+
+    def _search(self, query):
+        """scores for all matching documents. None if the query has no
+        terms left after analysis (e.g. only punctuation), in which case it
+        is dropped from the surrounding query, like in Lucene.
+        """
+        if isinstance(query, Term):
+            return self._search_term(query)
+        if isinstance(query, Phrase):
+            return self._search_phrase(query)
+
+        results = collections.defaultdict(list)
+        for occur, clause in query.clauses:
+            result = self._search(clause)
+            if result is not None:
+                results[occur].append(result)
+        if not results:
+            return None
+        must, should = results[MUST], results[SHOULD]
+        must_not = results[MUST_NOT]
+        scores = collections.Counter()
+        if must:
+            matches = set(must[0])
+            for result in must[1:]:
+                matches.intersection_update(result)
+            for result in must + should:
+                for doc_id, score in result.items():
+                    if doc_id in matches:
+                        scores[doc_id] += score
+        elif should:
+            for result in should:
+                scores.update(result)
+        elif must_not:
+            scores.update(dict.fromkeys(range(len(self.docs)), 0))
+        for result in must_not:
+            for doc_id in result:
+                scores.pop(doc_id, None)
+        return scores
+
+    def run_query(self, query: str, fl=None, **kwargs):
+        """run a Lucene query and return a response like Solr's:
+        ``numFound``, ``start`` and the ``docs`` list, best matches first.
+        ``limit``/``rows`` and ``offset``/``start`` work like in Solr.
+        """
+        if self.instruments is None:
+            return self._run_query(query, fl, **kwargs)
+        with self.instruments.timer("solr_query"):
+            return self._run_query(query, fl, **kwargs)
+
+    def _ranked(self, query, df=None):
+        """ids of the documents matching a query, best matches first"""
+        scores = self._search(parse_query(query, df)) or {}
+        return sorted(scores, key=lambda i: (-scores[i], i))
+
+    def _run_query(self, query: str, fl=None, **kwargs):
+        ranked = self._ranked(query, kwargs.get("df"))
+        start = int(kwargs.get("offset", kwargs.get("start", 0)))
+        limit = int(kwargs.get("limit", kwargs.get("rows", 10)))
+        return self._doclist(ranked, start, limit, fl)
+
+    def _doclist(self, ranked, start, limit, fl):
+        docs = []
+        for doc_id in ranked[start : start + limit]:
+            stored = self.docs[doc_id]
+            fields = fl or stored
+            # copies, so callers can modify them like parsed JSON.
+            docs.append({f: list(stored[f]) for f in fields if f in stored})
+        return {"numFound": len(ranked), "start": start, "docs": docs}
+
+    def run_queries(self, queries, fl=None, rows=10, batchsize=50, **kwargs):
+        """a response for each query, like SolrCore.run_queries: each batch
+        is one grouped request, so the docs are ranked by the whole batch.
+        """
+        queries = list(queries)
+        unique = list(dict.fromkeys(queries))
+        responses = {}
+        for i in range(0, len(unique), batchsize):
+            batch = unique[i : i + batchsize]
+            request = grouped_request(batch, rows, fl=fl, **kwargs)
+            responses.update(zip(batch, ungroup(batch, self.handle(request))))
+        return [responses[q] for q in queries]
+
+    def handle(self, request):
+        """answer a request to Solr's JSON request API: a dictionary with
+        ``query``, optional ``params`` and other request parameters. Result
+        grouping with ``group.query`` is supported, which is what
+        SolrCore.run_queries uses. As in Solr, the docs of each group are
+        ranked by the main query.
+        """
+        params = dict(request.get("params", {}))
+        params.update((k, v) for k, v in request.items() if k != "params")
+        query = params.pop("query", None) or params.pop("q", None)
+        if not query:
+            raise EmptyQuery("No search terms")
+        fl = params.pop("fl", None)
+        if isinstance(fl, str):
+            fl = fl.split(",")
+        if str(params.get("group")).lower() != "true":
+            return {"response": self.run_query(query, fl, **params)}
+
+        group_queries = params.get("group.query", [])
+        if isinstance(group_queries, str):
+            group_queries = [group_queries]
+        limit = int(params.get("group.limit", 1))
+        if self.instruments is None:
+            return self._grouped(query, group_queries, limit, fl, params)
+        with self.instruments.timer("solr_query"):
+            return self._grouped(query, group_queries, limit, fl, params)
+
+    def _grouped(self, query, group_queries, limit, fl, params):
+        # as in Solr, a group query only selects documents. They are ranked
+        # by their score for the main query, so the top documents of a group
+        # depend on the other queries in the request.
+        df = params.get("df")
+        ranked = self._ranked(query, df)
+        grouped = {}
+        for q in group_queries:
+            selected = set(self._ranked(q, df))
+            in_group = [i for i in ranked if i in selected]
+            grouped[q] = {
+                "matches": len(ranked),
+                "doclist": self._doclist(in_group, 0, limit, fl),
+            }
+        return {"grouped": grouped}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """serves the /query endpoint of LocalCores over HTTP, so code using
+    solrtools.SolrCore can run against them.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # send headers and body together. Separate small writes on a kept-alive
+    # connection run into delayed ACKs.
+    wbufsize = -1
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        *_, name, endpoint = ("/" + url.path.strip("/")).split("/")
+        core = self.server.cores.get(name)
+        if core is None or endpoint not in ("query", "select"):
+            return self.respond(404, {"error": {"msg": "not found"}})
+
+        request = {
+            key: values[0] if len(values) == 1 else values
+            for key, values in urllib.parse.parse_qs(url.query).items()
+        }
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            request.update(json.loads(self.rfile.read(length)))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        try:
+            body = core.handle(request)
+        except QueryError as e:
+            return self.respond(400, {"error": {"msg": str(e.args[0])}})
+        self.respond(200, body)
+
+    do_GET = do_POST
+
+    def respond(self, status, body):
+        body["responseHeader"] = {"status": 0 if status == 200 else status}
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    # clients without keep-alive open a connection for every query. With
+    # the default backlog of 5, the kernel drops connections under load and
+    # clients only try again a second later.
+    request_queue_size = 128
+
+
+def serve(cores, host="127.0.0.1", port=8983, delay=0):
+    """HTTP server for a dictionary of core names and LocalCores. Cores are
+    at http://host:port/name. Call ``serve_forever()`` on the result (in a
+    thread, for tests) and ``shutdown()`` to stop it. ``delay`` is added to
+    every request, in seconds, to simulate the latency of a remote server.
+    """
+    server = Server((host, port), RequestHandler)
+    server.cores = cores
+    server.delay = delay
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="serve Solr documents from a JSON lines file"
+    )
+    ap.add_argument("docs", help="file with one Solr document per line")
+    ap.add_argument("--core", default="nlibooks", help="name of the core")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8983)
+    args = ap.parse_args()
+    from .nlitools.solrmarc import LocalNliCore
+
+    server = serve(
+        {args.core: LocalNliCore.from_jsonl(args.docs)}, args.host, args.port
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
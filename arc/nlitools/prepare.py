@@ -1,9 +1,12 @@
+import argparse
+import collections
+import itertools
 import re
-from functools import partial
-import libaaron
+import sys
 
 DONT_COUNT = re.compile(r"^<<(.*?)>> *")
 HEB = r"אבגדהוזחטיכךלמםנןסעפףצץקרשת"
+HEB_CHARS = frozenset(HEB)
 MAQEF = re.compile(r"(?<=[" + HEB + r"])-(?=[" + HEB + "])")
 GERSHAYIM = re.compile(r"(?<=[" + HEB + r'])"(?=[' + HEB + "])")
 GERESH = re.compile(
@@ -48,17 +51,150 @@ def make_distinguisher(quoted, punct_re, punct):
     return distinguisher
 
 
-add_gershayim = make_distinguisher(QUOTED, GERSHAYIM, "״")
 add_geresh = make_distinguisher(
     re.compile(QUOTED.pattern.replace('"', "'")), GERESH, "׳"
 )
 
 
+def _closing_quote(text, start):
+    """position of the first quote from ``start`` on, on the same line,
+    which isn't followed by a Hebrew letter. -1 if there isn't one.
+    """
+    stop = text.find("\n", start)
+    if stop == -1:
+        stop = len(text)
+    end = text.find('"', start, stop)
+    while end != -1:
+        if end + 1 == len(text) or text[end + 1] not in HEB_CHARS:
+            return end
+        end = text.find('"', end + 1, stop)
+    return -1
+
+
+def quoted_bounds(text):
+    """set of the positions where QUOTED.split() would split the text, i.e.
+    the start and end of each quoted passage. Finds the same passages as
+    the regex, but only has to look at the quotes.
+    """
+    bounds = set()
+    length = len(text)
+    quote = text.find('"')
+    while quote != -1 and quote + 1 < length:
+        start = quote + 1
+        if text[start] not in HEB_CHARS:
+            first = start + 1
+        elif start + 1 < length and text[start + 1] in HEB_CHARS:
+            first = start + 2
+        elif (
+            text[start + 1 : start + 2] == '"'
+            and text[start + 2 : start + 3] in HEB_CHARS
+        ):
+            first = start + 3
+        else:
+            quote = text.find('"', start)
+            continue
+        end = _closing_quote(text, first)
+        if end == -1:
+            quote = text.find('"', start)
+            continue
+        bounds.add(start)
+        bounds.add(end)
+        # the closing quote can open the next passage.
+        quote = text.find('"', end - 1)
+    return bounds
+
+
+def add_gershayim(text):
+    """replace quotes between Hebrew letters with gershayim, except where
+    they open or close a quoted passage. Same output as
+    ``make_distinguisher(QUOTED, GERSHAYIM, "״")`` in one pass over the
+    quotes, without splitting the text.
+    """
+    if '"' not in text:
+        return text
+    bounds = quoted_bounds(text)
+    pieces = []
+    last = 0
+    quote = text.find('"', 1)
+    while quote != -1 and quote + 1 < len(text):
+        if (
+            text[quote - 1] in HEB_CHARS
+            and text[quote + 1] in HEB_CHARS
+            and quote not in bounds
+            and quote + 1 not in bounds
+        ):
+            pieces.append(text[last:quote])
+            pieces.append("״")
+            last = quote + 1
+        quote = text.find('"', quote + 1)
+    if not pieces:
+        return text
+    pieces.append(text[last:])
+    return "".join(pieces)
+
+
 def fix_nli_format(text):
-    return libaaron.pipe(
-        text,
-        partial(DONT_COUNT.sub, r"\1 @"),
-        add_gershayim,
-        partial(NUM_RANGE.sub, num_swap),
-        lambda s: s.replace("<", "(").replace(">", ")"),
+    """normalize a string from the NLI catalogue: a non-sorting prefix in
+    <<>> is marked with @, gershayim are restored, number ranges are put in
+    order and other angle brackets become parentheses. Steps are skipped
+    when the characters they look for aren't in the text.
+    """
+    if text.startswith("<<"):
+        text = DONT_COUNT.sub(r"\1 @", text)
+    if '"' in text:
+        text = add_gershayim(text)
+    if "-" in text:
+        text = NUM_RANGE.sub(num_swap, text)
+    if "<" in text or ">" in text:
+        text = text.replace("<", "(").replace(">", ")")
+    return text
+
+
+def fix_nli_batch(lines):
+    return [fix_nli_format(line) for line in lines]
+
+
+def fix_nli_lines(lines, jobs=1, batch_size=2000):
+    """yield fix_nli_format() for each of an iterable of lines (without
+    newlines), in order. With more than one job, batches of lines are
+    handled by worker processes, and no more than two batches per worker
+    are read ahead.
+    """
+    if jobs <= 1:
+        yield from map(fix_nli_format, lines)
+        return
+
+    import multiprocessing
+
+    lines = iter(lines)
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        while True:
+            batch = list(itertools.islice(lines, batch_size))
+            if not batch:
+                break
+            pending.append(pool.apply_async(fix_nli_batch, (batch,)))
+            if len(pending) >= jobs * 2:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="normalize NLI strings, one per line, for term lists"
+    )
+    ap.add_argument("file", nargs="?", help="input file (default: stdin)")
+    ap.add_argument(
+        "--jobs", "-j", type=int, default=1, help="worker processes"
     )
+    args = ap.parse_args()
+    infile = open(args.file) if args.file else sys.stdin
+    with infile:
+        lines = (line.rstrip("\n") for line in infile)
+        for line in fix_nli_lines(lines, args.jobs):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ from __future__ import annotations
 import sys
 import json
 from arc import solrtools as st
+from arc.localsolr import LocalCore
 from arc import picaqueries
 import tornado
 import typing as t
@@ -68,6 +69,21 @@ TITLEFILEDS = [
 NAMEFIELDS = list(
     map(getfield, ["name", "responsibility", "seriesPerson", "addedPerson"])
 )
+# copy fields used in queries and results. The NLI core is set up with these
+# (see solrtools.SolrCore.add_copy_fields).
+COPY_FIELDS = {"alltitles": TITLEFILEDS, "allnames": NAMEFIELDS}
+# fl projections: stored fields each kind of query actually reads. Full
+# records are big and most of their fields are never looked at.
+IDENTIFIER = getfield("001")
+RANKING_FIELDS = [
+    IDENTIFIER,
+    getfield("title"),
+    getfield("subtitle"),
+    getfield("responsibility"),
+    getfield("date"),
+    "allnames",
+]
+FULLNAME_FIELDS = [IDENTIFIER] + NAMEFIELDS
 NAMESPACE = "http://www.loc.gov/MARC21/slim"
 NS_MAP = {"marc": NAMESPACE}
 DATAFIELD = "{%s}datafield" % NAMESPACE
@@ -76,8 +92,12 @@ CONTROLFIELD = "{%s}controlfield" % NAMESPACE
 
 
 def gettitle(doc):
-    title = doc["245"][0]
-    parts = (title.get(sf) for sf in ("a", "b", "c"))
+    if "245" in doc:
+        title = doc["245"][0]
+        parts = (title.get(sf) for sf in ("a", "b", "c"))
+    else:
+        # a Solr document, like the ones getdocs returns.
+        parts = (doc.get(getfield(sf)) for sf in ("245_a", "245_b", "245_c"))
     return [h[0] if h else h for h in parts]
 
 
@@ -147,12 +167,16 @@ def distance_ratio(a: str, b: str):
     return (distance, (distance / len(a))) if len(a) else (0, 1.0)
 
 
+# escaped terms are cached, since the same candidates come up again and again.
+QUERIES = st.QueryBuilder()
+
+
 def mkfieldquery(
     fieldname, terms, escape=True, fuzzy=False, exact=False, and_=False
 ):
-    join = st.and_ if and_ else st.join
-    searchterms = join(terms, escape, fuzzy, exact)
-    return mkfield(fieldname, searchterms)
+    return QUERIES.field(
+        getfield(fieldname), terms, escape, fuzzy, exact, and_
+    )
 
 
 class NliCore(st.SolrCore):
@@ -164,14 +188,16 @@ class NliCore(st.SolrCore):
         fuzzy=False,
         exact=False,
         and_=False,
+        fl=None,
     ):
         query = mkfieldquery(fieldname, terms, escape, fuzzy, exact, and_)
-        return self.run_query(query)
+        return self.run_query(query, fl)
 
     def getfullnames(self, names):
         names = map(", ".join, filter(None, names))
         docs = self.run_query(
-            st.mkfield("allnames", st.join(names, True, False, True))
+            QUERIES.field("allnames", names, True, False, True),
+            FULLNAME_FIELDS,
         )["docs"]
 
         out = {}
@@ -179,13 +205,30 @@ class NliCore(st.SolrCore):
             found = []
             for field in NAMEFIELDS:
                 found += doc.get(field, [])
-            out[doc["001_txt"].pop()] = found
+            out[doc[IDENTIFIER].pop()] = found
 
         return out
 
 
+class LocalNliCore(LocalCore):
+    """offline stand-in for NliCore, with the documents in memory. See
+    arc.localsolr.
+    """
+
+    def __init__(self, docs=(), copy_fields=COPY_FIELDS, **kwargs):
+        super().__init__(docs, copy_fields, **kwargs)
+
+    @classmethod
+    def from_marcxml(cls, xmlpath, **kwargs):
+        return cls(marcxml2solr(xmlpath), **kwargs)
+
+    fieldsearch = NliCore.fieldsearch
+    getfullnames = NliCore.getfullnames
+
+
 class NliAsyncCore:
     _rsess = None
+    instruments = None
 
     @property
     def rsess(self):
@@ -203,9 +246,22 @@ class NliAsyncCore:
 
     # note that run_query_async returns an awaitable object.
     def run_query(self, query: str, fl=None, **kwargs) -> t.Awaitable[dict]:
-        return st.run_query_async(
+        response = st.run_query_async(
             self.url, self.session, query, fl=fl, **kwargs
         )
+        if self.instruments is None:
+            return response
+        return self.instruments.timed_await("solr_query", response)
+
+    def run_queries(
+        self, queries: t.Sequence[str], fl=None, rows=10, **kwargs
+    ) -> t.Awaitable[t.List[dict]]:
+        response = st.run_queries_async(
+            self.url, self.session, queries, fl=fl, rows=rows, **kwargs
+        )
+        if self.instruments is None:
+            return response
+        return self.instruments.timed_await("solr_batch", response)
 
     # therefore, fieldsearch will also return an awaitable object.
     fieldsearch = NliCore.fieldsearch
@@ -288,7 +344,7 @@ def solrdocgen():
 
 def getqueryparts(rlist):
     top3 = [s.replace("-", "") for s in map(str, rlist[:5])]
-    return st.or_(filter(None, top3), fuzzy=True)
+    return QUERIES.or_(filter(None, top3), fuzzy=True)
 
 
 def map_n_filter_queryparts(rlists):
@@ -299,9 +355,12 @@ def map_n_filter_queryparts(rlists):
             pass
 
 
-def getdocs(query, nlibooks):
+def getdocs(query, nlibooks, fl=RANKING_FIELDS):
+    """docs for a title query, with only the fields rank_results needs
+    unless ``fl`` says otherwise (None for whole records).
+    """
     try:
-        return nlibooks.run_query("alltitles:" + query)["docs"]
+        return nlibooks.run_query("alltitles:" + query, fl)["docs"]
     except st.QueryError as e:
         print(e.args[0])
         raise Exception()
@@ -309,8 +368,7 @@ def getdocs(query, nlibooks):
 
 def getdocyears(datestrings):
     for datestring in datestrings:
-        for year in dt.date2years(datestring):
-            yield from dt.yearnorm(year)
+        yield from dt.normyears(datestring)
 
 
 def split_no_punctuation(string_):
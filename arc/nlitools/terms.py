@@ -0,0 +1,145 @@
+"""
+Build the word frequency lists used as term dictionaries (see
+Config.get_term_counts and core.make_dicts) from an NLI MARC XML dump.
+
+Records are read from the XML in the main process. Their text is normalized
+with prepare.fix_nli_format, split into words and stripped with core.hebstrip.
+Worker processes count the words for batches of records and the main process
+merges the partial counts. The output is the same JSON word frequency object
+make_dicts reads, written from the most frequent word down.
+
+    arc-build-terms -j 8 -o terms.json nli-dump.xml
+"""
+import argparse
+import collections
+import itertools
+import json
+from pathlib import Path
+from . import core, prepare
+
+HEB_CHARS = prepare.HEB_CHARS
+
+
+def record_strings(record, tags=None):
+    """the text of all subfields in a record from solrmarc.marcxml2dicts,
+    or only those in the fields with the given tags.
+    """
+    for tag, fields in record.items():
+        if tag == "controlfields" or (tags and tag not in tags):
+            continue
+        for field in fields:
+            for values in field.values():
+                yield from values
+
+
+def count_words(strings, counter=None):
+    """count the Hebrew words in an iterable of NLI strings"""
+    counter = collections.Counter() if counter is None else counter
+    split = core.word_bound.split
+    hebstrip = core.hebstrip
+    words = []
+    for string in strings:
+        for word in split(prepare.fix_nli_format(string)):
+            word = hebstrip(word)[1]
+            if word and not HEB_CHARS.isdisjoint(word):
+                words.append(word)
+    counter.update(words)
+    return counter
+
+
+def batches(records, tags, size):
+    """lists of the strings in each ``size`` records"""
+    records = iter(records)
+    while True:
+        batch = []
+        n = 0
+        for n, record in enumerate(itertools.islice(records, size), 1):
+            batch.extend(record_strings(record, tags))
+        if not n:
+            return
+        yield batch
+
+
+def count_terms(records, tags=None, jobs=1, batch_size=1000):
+    """Counter of the words in an iterable of record dictionaries. With more
+    than one job, each batch of records is counted by a worker process and
+    the partial counts are merged as they come back. No more than two
+    batches per worker are read ahead.
+    """
+    counts = collections.Counter()
+    if jobs <= 1:
+        for batch in batches(records, tags, batch_size):
+            count_words(batch, counts)
+        return counts
+
+    import multiprocessing
+
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for batch in batches(records, tags, batch_size):
+            pending.append(pool.apply_async(count_words, (batch,)))
+            if len(pending) >= jobs * 2:
+                counts.update(pending.popleft().get())
+        while pending:
+            counts.update(pending.popleft().get())
+    return counts
+
+
+def write_terms(counts, path, min_count=1):
+    """write a word frequency object to a JSON file, most frequent first.
+    Words seen less than ``min_count`` times are left out.
+    """
+    terms = {w: n for w, n in counts.most_common() if n >= min_count}
+    with Path(path).open("w") as fh:
+        json.dump(terms, fh, ensure_ascii=False, separators=(",", ":"))
+    return len(terms)
+
+
+def build_terms(xmlpaths, output, tags=None, jobs=1, min_count=1):
+    """count the words in MARC XML files and write them to ``output``.
+    Returns the number of words written.
+    """
+    from .solrmarc import marcxml2dicts
+
+    records = itertools.chain.from_iterable(
+        marcxml2dicts(str(p)) for p in xmlpaths
+    )
+    counts = count_terms(records, tags, jobs)
+    return write_terms(counts, output, min_count)
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="build a term list from NLI MARC XML records"
+    )
+    ap.add_argument("xml", nargs="+", help="MARC XML files")
+    ap.add_argument("--output", "-o", required=True, help="JSON file to write")
+    ap.add_argument(
+        "--tags",
+        "-t",
+        nargs="*",
+        help="only count words in these MARC fields (default: all)",
+    )
+    ap.add_argument(
+        "--jobs", "-j", type=int, default=1, help="worker processes"
+    )
+    ap.add_argument(
+        "--min-count",
+        "-m",
+        type=int,
+        default=1,
+        help="leave out words seen fewer times than this",
+    )
+    args = ap.parse_args()
+    n = build_terms(
+        args.xml,
+        args.output,
+        set(args.tags) if args.tags else None,
+        args.jobs,
+        args.min_count,
+    )
+    print(n, "terms written to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,7 @@
-from libaaron.libaaron import pipe, pmap, pfilter
+import collections
+import json
+from pathlib import Path
+from libaaron.libaaron import pipe, pfilter
 import libaaron
 from arc import decode
 from . import filters
@@ -227,6 +230,8 @@ def gettitletext(titlefield):
 
 
 BAD_PROPS = "foreign yiddish_ending english_y arabic_article".split()
+# the tiers at which needs_conversion can reject a record, cheapest first
+REJECT_TIERS = "no_title", "hebrew", "precheck", "regex"
 
 
 def has_hebrew(record):
@@ -234,23 +239,90 @@ def has_hebrew(record):
     return lang and "Hebr" in lang
 
 
-def needs_conversion(record):
+PRECHECK_PROPS = "foreign_chars", "foreign_words"
+
+
+def foreign_precheck(line):
+    """True if the filters.Line ``line`` certainly has the "foreign"
+    property, going by the PRECHECK_PROPS tests. They look at the same line
+    data as the "foreign" regex and are much cheaper. False means they
+    couldn't tell.
+    """
+    return any(line.has(p) for p in PRECHECK_PROPS)
+
+
+def isforeign(line):
+    return any(line.has(p) for p in BAD_PROPS)
+
+
+def _text_tier(text):
+    line = filters.Line(text)
+    if foreign_precheck(line):
+        return "precheck"
+    if isforeign(line):
+        return "regex"
+    return "convert"
+
+
+def triage(record, memo=None):
+    """the tier at which needs_conversion decides about a record: one of
+    REJECT_TIERS, or "convert" if the record needs conversion. Title fields
+    are rejected with foreign_precheck before the BAD_PROPS regexes run on
+    them. ``memo`` is a dictionary to keep the results for title texts in.
+    """
     if record is None:
-        return False
+        return "no_title"
     title = record.get("021A")
-    if not title or has_hebrew(record):
-        return False
+    if not title:
+        return "no_title"
+    if has_hebrew(record):
+        return "hebrew"
+
+    tier = "precheck"
+    for text in map(gettitletext, title):
+        if memo is None:
+            text_tier = _text_tier(text)
+        else:
+            try:
+                text_tier = memo[text]
+            except KeyError:
+                text_tier = memo[text] = _text_tier(text)
+        if text_tier == "convert":
+            return "convert"
+        if text_tier == "regex":
+            tier = "regex"
+    return tier
 
-    isforeign = pipe(
-        map(gettitletext, title),
-        pmap(filters.Line),
-        pmap(lambda l: any(l.has(p) for p in BAD_PROPS)),
-        list,
-    )
-    if all(isforeign):
-        return False
 
-    return True
+def needs_conversion(record):
+    return triage(record) == "convert"
+
+
+def needs_conversion_many(records, stats=None):
+    """needs_conversion for each of a batch of records, as a list. Title
+    texts which come up again in the batch (series, reprints) are only
+    tested once. If ``stats`` is a Counter, the tier which decided about
+    each record is counted in it (see triage).
+    """
+    memo = {}
+    out = []
+    for record in records:
+        tier = triage(record, memo)
+        if stats is not None:
+            stats[tier] += 1
+        out.append(tier == "convert")
+    return out
+
+
+def triage_report(stats):
+    """lines with the number and fraction of records decided at each tier
+    in a Counter from needs_conversion_many.
+    """
+    total = sum(stats.values()) or 1
+    return [
+        "{:10} {:>10} {:7.2%}".format(tier, stats[tier], stats[tier] / total)
+        for tier in (*REJECT_TIERS, "convert")
+    ]
 
 
 def getpossiblenames(record, namedb):
@@ -268,8 +340,7 @@ def getpossiblenames(record, namedb):
 
 def getdocyears(datestrings):
     for datestring in datestrings:
-        for year in dt.date2years(datestring):
-            yield from dt.yearnorm(year)
+        yield from dt.normyears(datestring)
 
 
 namestarts = "028 055".split()
@@ -284,13 +355,23 @@ def getnamesfromwork(record):
     return sortedfromfields(record, namefields)
 
 
-def getnames(record, picanames):
+def getnames(record, picanames, authorities=None):
+    """names for a work record: (transnames, othernames) pairs from the
+    authority records it links to, or from the work record itself if there
+    are none. Authority records are looked up in ``picanames``, or through
+    ``authorities`` (an AuthorityCache) if it is given.
+    """
     ppns = set(getnameppns(record))
     if not ppns:
         return [getnamesfromwork(record)]
 
     names = []
     for ppn in ppns:
+        if authorities is not None:
+            sortednames = authorities.names(ppn)
+            if sortednames is not None:
+                names.append(sortednames)
+            continue
         try:
             authrecord = picanames[ppn]
         except KeyError:
@@ -305,6 +386,93 @@ def getnames(record, picanames):
     return [getnamesfromwork(record)]
 
 
+class AuthorityCache:
+    """memoizes the names parsed from authority records, and the name
+    components decoded from them, by PPN. Popular authors are linked from
+    thousands of works, so this saves looking up and parsing the same
+    records over and over.
+    """
+
+    def __init__(self, picanames, maxsize=2 ** 14, path=None):
+        """
+        - picanames: mapping of PPNs to authority records.
+        - maxsize: maximum number of PPNs to keep results for. The least
+          recently used are dropped first.
+        - path: JSON file where parsed names are persisted between runs.
+          They are loaded from it if it exists. Decoded components depend
+          on the session, so they are only kept in memory.
+        """
+        self.picanames = picanames
+        self.maxsize = maxsize
+        self.path = Path(path).expanduser() if path else None
+        self.cache = collections.OrderedDict()
+        self.components_cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.path and self.path.exists():
+            self.load()
+
+    def _get(self, cache, ppn, compute):
+        try:
+            value = cache[ppn]
+            cache.move_to_end(ppn)
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+        self.misses += 1
+        value = cache[ppn] = compute(ppn)
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return value
+
+    def _sortednames(self, ppn):
+        try:
+            authrecord = self.picanames[ppn]
+        except KeyError:
+            return None
+        transnames, othernames = getsortednames(authrecord)
+        if not transnames and not othernames:
+            return None
+        return transnames, othernames
+
+    def names(self, ppn):
+        """(transnames, othernames) for an authority record, or None if it
+        doesn't exist or has no names.
+        """
+        return self._get(self.cache, ppn, self._sortednames)
+
+    def components(self, ppn, session):
+        """name components and their decoded Hebrew candidates for an
+        authority record, as a frozenset. None if it has no names.
+        """
+
+        def compute(ppn):
+            names = self.names(ppn)
+            if names is None:
+                return None
+            return frozenset(namecomponents(names, session))
+
+        return self._get(self.components_cache, ppn, compute)
+
+    def clear(self):
+        self.cache.clear()
+        self.components_cache.clear()
+
+    def load(self, path=None):
+        with Path(path or self.path).open() as fh:
+            for ppn, names in json.load(fh).items():
+                if names is not None:
+                    names = tuple([tuple(n) for n in ns] for ns in names)
+                self.cache[ppn] = names
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def save(self, path=None):
+        with Path(path or self.path).open("w") as fh:
+            json.dump(self.cache, fh, ensure_ascii=False)
+
+
 def prerank(chunks, session):
     return session.usecache(chunks, dictionary=session.termdict)
 
@@ -316,20 +484,92 @@ def isconverted(record):
     return False
 
 
-def getnamecomponents(record, session):
-    allnames = getnames(record)
+def namecomponents(names, session):
+    transnames, nontrans = names
+    output = set()
+    for ln, fn in [*transnames, *nontrans]:
+        output.update(ln.split())
+        if fn:
+            output.update(fn.split())
+    for pair in transnames:
+        for name in pair:
+            if name:
+                chunks, _ = session.getchunks(name)
+                rlists, _ = prerank(chunks, session)
+                output.update(str(rep) for rl in rlists for rep in rl)
+    return output
+
+
+def getnamecomponents(record, session, picanames=None):
+    """all name components for a work, with their decoded candidates.
+    Authority records are resolved through ``session.authorities`` (see
+    Session.add_authorities), or looked up in ``picanames`` without caching
+    if the session has none.
+    """
+    authorities = session.authorities
     output = set()
-    for transnames, nontrans in allnames:
-        for ln, fn in [*transnames, *nontrans]:
-            output.update(ln.split())
-            if fn:
-                output.update(fn.split())
-        for pair in transnames:
-            for name in pair:
-                if name:
-                    chunks, _ = session.getchunks(name)
-                    rlists = prerank(chunks)
-                    output.update(str(rep) for rl in rlists for rep in rl)
+    if authorities is None:
+        if picanames is None:
+            raise ValueError(
+                "getnamecomponents needs picanames or a session with "
+                "authorities (see Session.add_authorities)"
+            )
+        for names in getnames(record, picanames):
+            output.update(namecomponents(names, session))
+    else:
+        found = False
+        for ppn in set(getnameppns(record)):
+            components = authorities.components(ppn, session)
+            if components is not None:
+                output.update(components)
+                found = True
+        if not found:
+            output = namecomponents(getnamesfromwork(record), session)
     output.discard("-")
     output.discard("בן")
     return output
+
+
+def read_batches(path, size=1000):
+    """the records in a PICA dump, in lists of ``size``"""
+    import itertools
+    import pica_parse
+
+    with open(path) as fh:
+        records = pica_parse.file2records(fh)
+        while True:
+            batch = list(itertools.islice(records, size))
+            if not batch:
+                return
+            yield batch
+
+
+def main():
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser(
+        description="count the tiers at which needs_conversion decides "
+        "about the records in PICA dumps"
+    )
+    ap.add_argument("dumps", nargs="+", help="PICA dumps")
+    ap.add_argument(
+        "--batch", type=int, default=1000, help="records per batch"
+    )
+    args = ap.parse_args()
+
+    stats = collections.Counter()
+    start = time.perf_counter()
+    for path in args.dumps:
+        for batch in read_batches(path, args.batch):
+            needs_conversion_many(batch, stats)
+    print(*triage_report(stats), sep="\n")
+    print(
+        "{} records in {:.1f}s".format(
+            sum(stats.values()), time.perf_counter() - start
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
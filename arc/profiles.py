@@ -0,0 +1,406 @@
+"""
+Compile transliteration profiles (data/*.yml) ahead of time.
+
+When a Decoder is built, deromanize.KeyGenerator expands the patterns in a
+profile (char_sets used in clusters, mid_patterns, beginning patterns and so
+on) into a trie of weighted replacements for each key group. For new.yml,
+that is over twenty thousand keys and most of the startup time.
+
+arc-compile-profile checks a profile and expands it once. It reports the
+size of each key group, the largest number of replacements for one key and
+the pattern entries which generate the most replacements. The expanded keys
+are pickled next to the profile (old.yml -> old.pickle). Unpickling runs
+whatever code the file says, so they are only used when they are asked for,
+with ``compiled_profiles: true`` in the config file or ``compiled=True``
+for Config.from_schema. Then the compiled keys are loaded instead of
+expanding the profile again, as long as the profile and the deromanize
+version haven't changed since it was compiled. If the file can't be loaded,
+the profile is expanded as usual.
+
+    arc-compile-profile data/old.yml data/new.yml data/gk.yml
+"""
+import argparse
+import gc
+import hashlib
+import pickle
+import sys
+from pathlib import Path
+import deromanize as dr
+from deromanize import keygenerator as kg
+
+# bump when the layout of the pickled data changes
+FORMAT = 1
+# sections of the profile arc.decode.Decoder needs besides the keys
+DECODER_SECTIONS = (
+    "vowels",
+    "consonants",
+    "joined_prefixes",
+    "prefix_vowels",
+    "gem_prefixes",
+    "to_new",
+)
+# key groups deromanize.front_mid_end_decode uses
+DECODE_GROUPS = "front", "mid", "end"
+
+
+class ProfileError(Exception):
+    """a profile can't be compiled. ``problems`` lists what is wrong."""
+
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__("\n".join(problems))
+
+
+class CompiledKeys:
+    """the expanded key groups of a profile, with the parts of the
+    deromanize.KeyGenerator interface the decoder uses.
+    """
+
+    __slots__ = "profile", "keys"
+
+    def __init__(self, profile, keys):
+        self.profile = profile
+        self.keys = keys
+
+    def __getitem__(self, key):
+        return self.keys[key]
+
+    def __iter__(self):
+        return iter(self.keys)
+
+
+def _deromanize_version():
+    try:
+        from importlib import metadata
+    except ImportError:
+        return None
+    try:
+        return metadata.version("deromanize")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _bad_value(value):
+    """whether a profile value isn't something a ReplacementList can be
+    built from: a string, a [weight, string] pair or a list of those.
+    """
+    if isinstance(value, str):
+        return False
+    if not isinstance(value, list) or not value:
+        return True
+    if isinstance(value[0], int):
+        return len(value) != 2 or not isinstance(value[1], str)
+    return any(
+        not isinstance(v, str)
+        and (
+            not isinstance(v, list)
+            or len(v) != 2
+            or not isinstance(v[0], int)
+            or not isinstance(v[1], str)
+        )
+        for v in value
+    )
+
+
+def _groups(info):
+    """(section, weight) for each group of a key definition, in the order
+    KeyGenerator.keygen applies them.
+    """
+    if isinstance(info, dict):
+        groups = info.get("groups", [])
+    else:
+        groups = info
+    if isinstance(groups, str):
+        groups = [groups]
+    for group in groups:
+        if isinstance(group, str):
+            yield group, None
+        elif isinstance(group, dict):
+            yield from group.items()
+        else:
+            yield from group[::-1]
+
+
+def check_profile(profile):
+    """list of problems with the structure of a profile that would make
+    KeyGenerator fail or silently build the wrong keys.
+    """
+    problems = []
+    keys = profile.get("keys")
+    if not isinstance(keys, dict):
+        return ["the profile has no 'keys' section"]
+    for name in DECODE_GROUPS:
+        if name not in keys:
+            problems.append("no %r key group" % name)
+
+    checked = set()
+    for name, info in keys.items():
+        parent = info.get("parent") if isinstance(info, dict) else None
+        if parent is not None and parent not in keys:
+            problems.append(
+                "key group %r: parent %r is not a key group" % (name, parent)
+            )
+        for section, weight in _groups(info):
+            if weight is not None and not isinstance(weight, int):
+                problems.append(
+                    "key group %r: weight of %r is %r, not an integer"
+                    % (name, section, weight)
+                )
+            if section not in profile:
+                problems.append(
+                    "key group %r: there is no section %r" % (name, section)
+                )
+                continue
+            if section in checked:
+                continue
+            checked.add(section)
+            if not isinstance(profile[section], dict):
+                problems.append("section %r is not a mapping" % section)
+                continue
+            for key, value in profile[section].items():
+                if not isinstance(key, str) or _bad_value(value):
+                    problems.append(
+                        "section %r: bad entry %r: %r" % (section, key, value)
+                    )
+
+    for alias, definition in profile.get("char_sets", {}).items():
+        chars = (
+            definition.get("chars")
+            if isinstance(definition, dict)
+            else definition
+        )
+        if isinstance(chars, str) and chars not in profile:
+            problems.append(
+                "char set %r: there is no section %r" % (alias, chars)
+            )
+        elif chars is None:
+            problems.append("char set %r has no chars" % alias)
+    return problems
+
+
+def missing_sections(profile):
+    """sections arc.decode.Decoder needs which aren't in the profile.
+    Profiles without them can still be used with deromanize directly.
+    """
+    return [s for s in DECODER_SECTIONS if s not in profile]
+
+
+def expand_profile(profile):
+    """check a profile and build its keys. Returns the KeyGenerator. Raises
+    ProfileError if the profile has problems.
+    """
+    problems = check_profile(profile)
+    if problems:
+        raise ProfileError(problems)
+    try:
+        keygen = dr.KeyGenerator(profile)
+    except (kg.KeyGeneratorError, KeyError, TypeError, IndexError) as e:
+        raise ProfileError(["keys can't be generated: %r" % e])
+    empty = [
+        "key group %r: %r has no replacements" % (name, key)
+        for name, group in keygen.keys.items()
+        for key, replist in group.items()
+        if not replist
+    ]
+    if empty:
+        raise ProfileError(empty)
+    return keygen
+
+
+def group_stats(keys):
+    """dictionary of statistics for each key group: the number of keys and
+    replacements and the key with the most replacements (the worst-case
+    fan-out for that part of a token).
+    """
+    stats = {}
+    for name in keys:
+        group = keys[name]
+        n_keys = n_reps = fan_out = 0
+        widest = None
+        for key, replist in group.items():
+            n_keys += 1
+            n_reps += len(replist)
+            if len(replist) > fan_out:
+                fan_out, widest = len(replist), key
+        stats[name] = dict(
+            keys=n_keys, replacements=n_reps, fan_out=fan_out, widest=widest
+        )
+    return stats
+
+
+def entry_costs(keygen):
+    """(section, pattern, keys, replacements) for each entry that uses a char
+    set in the sections the key groups are built from, most replacements
+    first.
+    """
+    profile = keygen.profile
+    aliases = list(keygen.char_sets)
+    sections = dict.fromkeys(
+        section
+        for info in profile["keys"].values()
+        for section, _ in _groups(info)
+    )
+    costs = []
+    for section in sections:
+        for pattern, value in profile[section].items():
+            if not any(a in pattern for a in aliases):
+                continue
+            generated = keygen.patterngen(
+                pattern, value, broken_clusters=keygen.broken
+            )
+            n_reps = sum(len(r) for r in generated.values())
+            costs.append((section, pattern, len(generated), n_reps))
+    costs.sort(key=lambda c: c[3], reverse=True)
+    return costs
+
+
+def digest(path):
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def _header(source):
+    """what identifies the profile and versions a file was compiled from"""
+    return dict(
+        format=FORMAT, digest=digest(source), deromanize=_deromanize_version()
+    )
+
+
+def compiled_path(path):
+    return Path(path).with_suffix(".pickle")
+
+
+def write_compiled(keygen, source, output=None):
+    """pickle the profile and expanded keys from a KeyGenerator built from
+    the profile at ``source``. Returns the path written. A header with the
+    digest of the profile comes first, so stale files can be recognized
+    without loading the keys.
+    """
+    output = Path(output) if output else compiled_path(source)
+    header = _header(source)
+    with output.open("wb") as fh:
+        pickle.dump(header, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(
+            (keygen.profile, keygen.keys),
+            fh,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    return output
+
+
+def load_compiled(source):
+    """the CompiledKeys for the profile at ``source``, or None if it hasn't
+    been compiled or was compiled from a different version of the profile
+    or with a different version of deromanize, or can't be loaded. Only
+    load compiled profiles you made yourself; they are pickles. The header
+    shows whether a file is stale, not who wrote it.
+    """
+    path = compiled_path(source)
+    if not path.exists():
+        return None
+    header = _header(source)
+    # unpickling creates hundreds of thousands of small objects, which
+    # sets off the cyclic garbage collector over and over for nothing.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with path.open("rb") as fh:
+            if pickle.load(fh) != header:
+                return None
+            profile, keys = pickle.load(fh)
+    except Exception:
+        # whatever went wrong, the profile itself still works.
+        return None
+    finally:
+        if enabled:
+            gc.enable()
+    return CompiledKeys(profile, keys)
+
+
+def report(name, keygen, top=10, file=sys.stdout):
+    print("%s:" % name, file=file)
+    stats = group_stats(keygen)
+    print(
+        "  {:<8} {:>8} {:>12} {:>8}  {}".format(
+            "group", "keys", "replacements", "fan-out", "widest key"
+        ),
+        file=file,
+    )
+    for group, s in stats.items():
+        print(
+            "  {:<8} {keys:>8} {replacements:>12} {fan_out:>8}  {widest}"
+            .format(group, **s),
+            file=file,
+        )
+    if all(g in stats for g in DECODE_GROUPS):
+        worst = 1
+        for group in DECODE_GROUPS:
+            worst *= stats[group]["fan_out"] or 1
+        print(
+            "  worst case for a token with one part of each of front, mid "
+            "and end: %d candidates" % worst,
+            file=file,
+        )
+    missing = missing_sections(keygen.profile)
+    if missing:
+        print(
+            "  can't be used by arc.decode.Decoder, missing:",
+            ", ".join(missing),
+            file=file,
+        )
+    costs = entry_costs(keygen)[:top]
+    if costs:
+        print("  most expensive patterns:", file=file)
+        for section, pattern, n_keys, n_reps in costs:
+            print(
+                "    {:>8} reps {:>6} keys  {}: {}".format(
+                    n_reps, n_keys, section, pattern
+                ),
+                file=file,
+            )
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="check transliteration profiles, report the size of "
+        "their keys and compile them for faster decoder startup. Compiled "
+        "profiles are used with 'compiled_profiles: true' in the config file."
+    )
+    ap.add_argument("profiles", nargs="+", help="YAML profiles")
+    ap.add_argument(
+        "--check",
+        "-c",
+        action="store_true",
+        help="check and report, but don't write compiled profiles",
+    )
+    ap.add_argument(
+        "--top",
+        "-t",
+        type=int,
+        default=10,
+        help="how many of the most expensive patterns to list",
+    )
+    args = ap.parse_args()
+
+    import yaml
+
+    failed = False
+    for path in map(Path, args.profiles):
+        with path.open() as fh:
+            profile = yaml.safe_load(fh)
+        try:
+            keygen = expand_profile(profile)
+        except ProfileError as e:
+            print("%s: invalid profile" % path, file=sys.stderr)
+            for problem in e.problems:
+                print("  " + problem, file=sys.stderr)
+            failed = True
+            continue
+        report(path.stem, keygen, args.top)
+        if not args.check:
+            print("  compiled to", write_compiled(keygen, path))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+"""
+HTTP service for converting romanized titles and finding them in the NLI
+catalogue.
+
+    POST /convert  {"text": "..."} or {"lines": [...]}, optionally "crop"
+    POST /match    {"title": "...", "names": [...], "years": [...]}
+    GET  /stats    batching counters
+
+/convert answers with the top candidates for each chunk of a line, as
+``derom --json`` writes them, and the standard Session.pickdecoder picked.
+/match also queries Solr with the top candidates for each word and ranks
+the results with solrmarc.rank_results.
+
+Sessions come from a sessionpool.SessionPool. Requests that arrive at about
+the same time are coalesced into micro-batches: the lines of a batch are
+converted with one call into a session's thread instead of a thread hop
+each, the cached forms for all of their words are fetched with one bulk
+query, and the title queries of a batch of /match requests are sent to
+Solr concurrently, one request per title. They aren't combined into one
+grouped request, because Solr would rank the docs for each title by all
+the titles of the batch. A batch is sent when it has ``batch_size``
+items, or ``batch_delay`` seconds after its first item arrived, so an idle
+server only adds that delay. Batches for different sessions run at the
+same time.
+
+    arc-server --port 8000 --sessions 4 --warm warm.json
+
+benchmarks/loadtest.py measures throughput and latency against a local
+stand-in for Solr.
+"""
+import argparse
+import asyncio
+import collections
+import inspect
+import json
+import tornado.httpclient
+import tornado.web
+from . import cacheutils as cu
+from . import decode
+from . import solrtools as st
+from .sessionpool import SessionPool
+
+
+class MicroBatcher:
+    """coalesces the items submitted by concurrent coroutines into batches
+    for ``handler``, a coroutine function which takes a list of items and
+    returns a list with a result for each. A result which is an exception
+    is raised in the coroutine that submitted its item.
+    """
+
+    def __init__(self, handler, size=32, delay=0.002):
+        self.handler = handler
+        self.size = size
+        self.delay = delay
+        self.pending = []
+        self._timer = None
+        self.stats = collections.Counter()
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.delay, self.flush
+            )
+        return await future
+
+    def flush(self):
+        """send the pending items now"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.pending:
+            batch, self.pending = self.pending, []
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        self.stats["batches"] += 1
+        self.stats["items"] += len(batch)
+        try:
+            results = await self.handler([item for item, _ in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def prefetch_forms(session, batch):
+    """fetch the cached LOC/ALA and phonological forms of all candidates
+    for the words in a list of Chunks with one query per cache, so usecache
+    finds them in memory.
+    """
+    loc_forms = {}
+    phon_forms = {}
+    for chunks in batch:
+        decoder = chunks.decoder
+        for chunk in chunks:
+            if not isinstance(chunk, decode.Chunk):
+                continue
+            rlist = chunk.base.stripped_heb
+            if rlist is None:
+                continue
+            loc_keys, phon_keys = cu.collect_keys(rlist[:10], decoder)
+            loc_forms.update(dict.fromkeys(loc_keys))
+            phon_forms.update(dict.fromkeys(phon_keys))
+    session.caches.loc.prefetch(loc_forms)
+    session.caches.phon.prefetch(phon_forms)
+
+
+def convert_batch(session, lines, crop=None, compact=True, prefetch=True):
+    """decode a batch of lines and rerank their candidates with the caches.
+    Returns a dictionary for each line, with the top ``crop`` candidates
+    for each chunk. Without ``compact``, the reranked ReplacementLists are
+    under "words" instead. A line which can't be converted gets an
+    "error", and the rest of the batch is converted as usual.
+    """
+    decoded = []
+    for line in lines:
+        try:
+            decoded.append((line, *session.getchunks(line)))
+        except Exception as e:
+            decoded.append((line, e, None))
+    if prefetch and len(lines) > 1:
+        prefetch_forms(
+            session, [c for _, c, _ in decoded if not isinstance(c, Exception)]
+        )
+
+    out = []
+    for line, chunks, input_info in decoded:
+        if isinstance(chunks, Exception):
+            out.append({"input": line, "error": repr(chunks)})
+            continue
+        try:
+            words, conversion_info = session.usecache(chunks, compact=compact)
+            result = {
+                "input": line,
+                "standard": input_info.standard.name,
+                "fully_converted": conversion_info.fully_converted,
+            }
+            if compact:
+                result["chunks"] = [
+                    {
+                        "rom": chunk.rom,
+                        "candidates": [
+                            [w.heb, w.weight] for w in word.top(crop)
+                        ],
+                    }
+                    for chunk, word in zip(chunks, words)
+                ]
+            else:
+                result["words"] = words
+        except Exception as e:
+            result = {"input": line, "error": repr(e)}
+        out.append(result)
+    return out
+
+
+def title_queries(session, titles, prefetch=True):
+    """the Solr title query and the top candidates for each word (as
+    strings) for a batch of titles. The query is None for a title with
+    no words to look for, and a title which can't be decoded gets an
+    exception instead.
+    """
+    from .nlitools import solrmarc
+
+    out = []
+    for result in convert_batch(
+        session, titles, compact=False, prefetch=prefetch
+    ):
+        if "error" in result:
+            out.append(ValueError(result["error"]))
+            continue
+        words = result["words"]
+        parts = list(solrmarc.map_n_filter_queryparts(words))
+        query = None
+        if parts:
+            query = "alltitles:" + solrmarc.QUERIES.and_(parts, escape=False)
+        out.append((query, [[str(r) for r in rlist[:10]] for rlist in words]))
+    return out
+
+
+class Service:
+    """the conversion and matching behind the HTTP handlers, with a batcher
+    for each.
+    """
+
+    def __init__(
+        self,
+        pool: SessionPool,
+        core=None,
+        batch_size=32,
+        batch_delay=0.002,
+        crop=5,
+        rows=5,
+        prefetch=True,
+    ):
+        """
+        - pool: SessionPool to convert with
+        - core: Solr core for /match, an NliAsyncCore (or anything with
+          the same run_query method)
+        - batch_size, batch_delay: see MicroBatcher
+        - crop: default number of candidates for each chunk
+        - rows: number of Solr results to rank for each title
+        - prefetch: fetch the cached forms for a batch with one query
+        """
+        self.pool = pool
+        self.core = core
+        self.crop = crop
+        self.rows = rows
+        self.prefetch = prefetch
+        self.converter = MicroBatcher(
+            self._convert_batch, batch_size, batch_delay
+        )
+        self.matcher = MicroBatcher(self._match_batch, batch_size, batch_delay)
+
+    async def convert(self, line, crop=None):
+        return await self.converter.submit((line, crop or self.crop))
+
+    async def match(self, title, names=(), years=()):
+        return await self.matcher.submit((title, names, years))
+
+    async def _convert_batch(self, items):
+        # items with the same crop go together; it's nearly always one.
+        by_crop = collections.defaultdict(list)
+        for i, (line, crop) in enumerate(items):
+            by_crop[crop].append(i)
+        out = [None] * len(items)
+        for crop, indices in by_crop.items():
+            results = await self.pool.run(
+                convert_batch,
+                [items[i][0] for i in indices],
+                crop,
+                prefetch=self.prefetch,
+            )
+            for i, result in zip(indices, results):
+                out[i] = result
+        return out
+
+    async def _match_batch(self, items):
+        from .nlitools import solrmarc
+
+        prepared = await self.pool.run(
+            title_queries,
+            [title for title, _, _ in items],
+            prefetch=self.prefetch,
+        )
+        queries = list(
+            dict.fromkeys(
+                p[0]
+                for p in prepared
+                if not isinstance(p, Exception) and p[0] is not None
+            )
+        )
+        # one request per title, all at the same time. In a grouped request,
+        # Solr would rank the docs for each title by all the titles of the
+        # batch, so the results would depend on what else arrived with it.
+        results = await asyncio.gather(
+            *(self._query(q, solrmarc.RANKING_FIELDS) for q in queries),
+            return_exceptions=True,
+        )
+        responses = dict(zip(queries, results))
+
+        out = []
+        for (title, names, years), p in zip(items, prepared):
+            if isinstance(p, Exception):
+                out.append(p)
+                continue
+            query, replists = p
+            response = responses.get(query)
+            if isinstance(response, Exception):
+                out.append(response)
+                continue
+            docs = response["docs"] if query is not None else []
+            matches = solrmarc.rank_results(names, years, replists, docs)
+            out.append(
+                {
+                    "input": title,
+                    "query": query,
+                    "matches": [
+                        {
+                            "identifier": m["doc"][solrmarc.IDENTIFIER][0],
+                            "title": solrmarc.prepare_doctitle(m["doc"]),
+                            "diff": m["diff"],
+                            "dates": m["dates"],
+                            "names": m["names"],
+                        }
+                        for m in matches
+                    ],
+                }
+            )
+        return out
+
+    async def _query(self, query, fl):
+        result = self.core.run_query(query, fl=fl, limit=self.rows)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    def stats(self):
+        return {
+            "convert": dict(self.converter.stats),
+            "match": dict(self.matcher.stats),
+        }
+
+
+def is_strings(value):
+    return isinstance(value, list) and all(isinstance(v, str) for v in value)
+
+
+class JSONHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def json_body(self):
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            self.invalid("invalid JSON")
+        if not isinstance(body, dict):
+            self.invalid("expected an object")
+        return body
+
+    def invalid(self, reason):
+        raise tornado.web.HTTPError(400, reason=reason)
+
+    def write_json(self, obj):
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(json.dumps(obj, ensure_ascii=False))
+
+    def write_error(self, status_code, **kwargs):
+        self.write_json({"error": self._reason})
+
+
+class ConvertHandler(JSONHandler):
+    async def post(self):
+        body = self.json_body()
+        crop = body.get("crop")
+        # bool is an int too
+        if crop is not None and (type(crop) is not int or crop < 1):
+            self.invalid("crop must be a positive integer")
+        if "lines" in body:
+            if not is_strings(body["lines"]):
+                self.invalid("lines must be a list of strings")
+            results = await asyncio.gather(
+                *(self.service.convert(line, crop) for line in body["lines"])
+            )
+            self.write_json({"results": results})
+        elif "text" in body:
+            if not isinstance(body["text"], str):
+                self.invalid("text must be a string")
+            self.write_json(await self.service.convert(body["text"], crop))
+        else:
+            self.invalid("no text or lines")
+
+
+class MatchHandler(JSONHandler):
+    async def post(self):
+        if self.service.core is None:
+            raise tornado.web.HTTPError(404, reason="no Solr core")
+        body = self.json_body()
+        try:
+            title = body["title"]
+        except KeyError:
+            self.invalid("no title")
+        if not isinstance(title, str):
+            self.invalid("title must be a string")
+        names = body.get("names", [])
+        if not is_strings(names):
+            self.invalid("names must be a list of strings")
+        years = body.get("years", [])
+        if not isinstance(years, list) or not all(
+            type(y) in (str, int) for y in years
+        ):
+            self.invalid("years must be a list of strings or integers")
+        try:
+            result = await self.service.match(title, names, years)
+        except ValueError as e:
+            raise tornado.web.HTTPError(422, reason=str(e.args[0]))
+        except (st.QueryError, tornado.httpclient.HTTPError, OSError):
+            raise tornado.web.HTTPError(502, reason="Solr request failed")
+        self.write_json(result)
+
+
+class StatsHandler(JSONHandler):
+    def get(self):
+        self.write_json(self.service.stats())
+
+
+def make_app(service):
+    kwargs = {"service": service}
+    return tornado.web.Application(
+        [
+            (r"/convert", ConvertHandler, kwargs),
+            (r"/match", MatchHandler, kwargs),
+            (r"/stats", StatsHandler, kwargs),
+        ]
+    )
+
+
+def setup_session(session, warm=None):
+    """add the decoders pickdecoder uses and warm the session up"""
+    session.add_decoders(["old", "new"], fix_numerals=True)
+    if "pi" in session.config.schemas:
+        session.add_decoder("pi", fix_numerals=True)
+    else:
+        # there's no PI profile in data/. The old one is the closest thing.
+        session.decoders.pi = session.decoders.old
+    if warm or session.config.user_conf.get("warm_cache"):
+        session.warm(warm)
+
+
+async def serve(args):
+    pool = SessionPool(
+        args.config,
+        size=args.sessions,
+        setup=lambda s: setup_session(s, args.warm),
+    )
+    await pool.start()
+    core = None
+    if args.solr_url:
+        from .nlitools import solrmarc
+
+        core = solrmarc.NliAsyncCore(args.solr_url + "/" + args.core)
+    elif hasattr(pool.config, "solr_url"):
+        core = pool.add_core(args.core)
+    service = Service(
+        pool,
+        core,
+        batch_size=args.batch_size,
+        batch_delay=args.batch_delay / 1000,
+        prefetch=not args.no_prefetch,
+    )
+    make_app(service).listen(args.port, args.host)
+    print("listening on http://{}:{}".format(args.host, args.port), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        pool.close()
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="HTTP service for converting titles and matching them "
+        "against the NLI catalogue"
+    )
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--config", help="config file (default: the user's)")
+    ap.add_argument(
+        "--sessions", type=int, default=2, help="sessions in the pool"
+    )
+    ap.add_argument(
+        "--batch-size", type=int, default=32, help="most items in a batch"
+    )
+    ap.add_argument(
+        "--batch-delay",
+        type=float,
+        default=2,
+        help="longest wait for a batch to fill, in ms",
+    )
+    ap.add_argument(
+        "--no-prefetch",
+        action="store_true",
+        help="don't fetch a batch's cached forms in bulk",
+    )
+    ap.add_argument(
+        "--warm",
+        metavar="FILE",
+        help="warm-cache file (default: warm_cache from the config)",
+    )
+    ap.add_argument(
+        "--solr-url", help="Solr URL (default: solr_url from the config)"
+    )
+    ap.add_argument("--core", default="nlibooks", help="Solr core for /match")
+    args = ap.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
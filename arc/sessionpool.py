@@ -0,0 +1,149 @@
+"""
+A pool of Sessions for asynchronous (tornado/asyncio) servers.
+
+A Session isn't safe to share between threads: its cache lookups go
+through one SQLAlchemy session and its decoders keep unsynchronized caches.
+Using one from a coroutine directly blocks the event loop on every query.
+
+SessionPool keeps a fixed number of sessions, each in its own worker
+thread. A session is built in its thread and its synchronous work always
+runs there, while the event loop only waits for results. A request takes
+a free session and gives it back when it's done. Requests that find no
+free session wait in the pool, so the number of requests being worked on
+is bounded by the number of sessions. Threads are used rather than
+processes because chunks and their decoders would have to be pickled for
+every call. SQLite releases the GIL while it runs a query. The only object
+the sessions share is the process-wide spell checker (arc.spelling), which
+has a lock.
+
+    pool = SessionPool(size=4, setup=lambda s: s.add_decoders(["old"]))
+    await pool.start()
+    chunks, info, words, conversion = await pool.convert(line)
+"""
+import asyncio
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from .config import Config, Session
+
+
+def convert(session, string, **kwargs):
+    """pick a decoder for a string, decode it and rerank the candidates
+    with the caches. Returns the chunks, their InputInfo, the reranked
+    words and their ConversionInfo.
+    """
+    chunks, input_info = session.getchunks(string)
+    words, conversion_info = session.usecache(chunks, **kwargs)
+    return chunks, input_info, words, conversion_info
+
+
+class SessionPool:
+    """a fixed number of sessions, each with a worker thread of its own."""
+
+    def __init__(self, path=None, loader=None, size=2, setup=None):
+        """
+        - path, loader: as for Config
+        - size: number of sessions
+        - setup: function called with each new session in its thread, e.g.
+          to add decoders and warm the session up.
+        """
+        self.config = Config(path=path, loader=loader)
+        self.size = size
+        self.setup = setup
+        self.sessions = []
+        self.executors = []
+        self.cores = {}
+        self._idle = None
+        self._starting = asyncio.Lock()
+
+    def _build(self, executor):
+        session = Session(self.config, asynchro=True, executor=executor)
+        session.cores.update(self.cores)
+        if self.setup:
+            self.setup(session)
+        return session
+
+    async def start(self):
+        """build the sessions in their threads. Called by the first request
+        if it hasn't been called yet. If building a session fails, the
+        error is raised and the next call tries again.
+        """
+        async with self._starting:
+            if self._idle is not None:
+                return self
+            loop = asyncio.get_running_loop()
+            self.executors = [
+                ThreadPoolExecutor(1, thread_name_prefix="arc-session-%d" % i)
+                for i in range(self.size)
+            ]
+            # the first session creates the cache tables if they're missing.
+            # Sessions building at the same time would all try to.
+            first, *rest = self.executors
+            try:
+                sessions = [
+                    await loop.run_in_executor(first, self._build, first)
+                ]
+                sessions += await asyncio.gather(
+                    *(
+                        loop.run_in_executor(executor, self._build, executor)
+                        for executor in rest
+                    )
+                )
+            except BaseException:
+                for executor in self.executors:
+                    executor.shutdown(wait=False)
+                self.executors = []
+                raise
+            # requests only wait for sessions once they're all built.
+            idle = asyncio.Queue()
+            for session in sessions:
+                idle.put_nowait(session)
+            self.sessions = sessions
+            self._idle = idle
+        return self
+
+    def add_core(self, name):
+        """add an asynchronous NLI core to all sessions. It's only used on
+        the event loop, so one is shared by all of them. Call this from the
+        event loop rather than Session.add_core from a session's thread.
+        """
+        core = self.cores.get(name)
+        if core is None:
+            from .nlitools import solrmarc
+
+            core = self.cores[name] = solrmarc.NliAsyncCore(
+                self.config.solr_url + "/" + name
+            )
+            for session in self.sessions:
+                session.cores[name] = core
+        return core
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        """a free session for the duration of the block. Waits for one if
+        they're all in use.
+        """
+        if self._idle is None:
+            await self.start()
+        session = await self._idle.get()
+        try:
+            yield session
+        finally:
+            self._idle.put_nowait(session)
+
+    async def run(self, func, *args, **kwargs):
+        """``func(session, *args, **kwargs)`` in the thread of a free
+        session.
+        """
+        async with self.session() as session:
+            return await session.run_async(func, session, *args, **kwargs)
+
+    async def convert(self, string, **kwargs):
+        """convert() on a free session"""
+        return await self.run(convert, string, **kwargs)
+
+    def close(self):
+        for executor in self.executors:
+            executor.shutdown()
+        self.executors = []
+        self.sessions = []
+        self._idle = None
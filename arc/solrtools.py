@@ -5,13 +5,30 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 import tornado.httpclient
 import libaaron
+import codecs
+import contextlib
 import re
 import requests
 import typing as t
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 decode = json.JSONDecoder().decode
 encode = json.JSONEncoder(ensure_ascii=False).encode
+raw_decode = json.JSONDecoder().raw_decode
+
+
+def loads(data):
+    """decode a JSON response body, bytes or str. Uses orjson if it's
+    installed, which is several times faster for big responses.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 # schema API
 hebrew_text = {
@@ -35,13 +52,21 @@ heb_text_template = {
 _sp = r'\ + - && || ! ( ) { } [ ] ^ " ~ * ? :'.split()
 _sp.append(" ")
 SPECIAL_CHARS = re.compile("(" + "|".join(re.escape(c) for c in _sp) + ")")
+# single-character specials can be escaped with str.translate. && and || are
+# only special in pairs.
+ESCAPE_TABLE = str.maketrans({c: "\\" + c for c in _sp if len(c) == 1})
 
 
 def lucene_escape(word):
     """takes a string as input and properly escapes it for use in a
     Lucene query.
     """
-    return SPECIAL_CHARS.sub(r"\\\1", word)
+    word = word.translate(ESCAPE_TABLE)
+    if "&&" in word:
+        word = word.replace("&&", r"\&&")
+    if "||" in word:
+        word = word.replace("||", r"\||")
+    return word
 
 
 def strip_gross_chars(field):
@@ -63,29 +88,26 @@ class EmptyQuery(QueryError):
     pass
 
 
+def _fuzzy_suffix(fuzzy):
+    fz = "~" if fuzzy else ""
+    if not isinstance(fuzzy, bool):
+        fz += str(fuzzy)
+    return fz
+
+
 def join(terms, escape=True, fuzzy=False, exact=False, joiner=None):
     if exact:
         terms = ('"{}"'.format(t.replace('"', r"\"")) for t in terms)
     elif escape:
         terms = map(lucene_escape, terms)
+    return _join(list(terms), _fuzzy_suffix(fuzzy), joiner)
 
-    fz = ""
-    if fuzzy:
-        fz += "~"
-    if not isinstance(fuzzy, bool):
-        fz += str(fuzzy)
-
-    if joiner:
-        joiner = " {} ".format(joiner)
-    else:
-        joiner = " "
 
-    parts = [p for term in terms for p in (term, fz, joiner)]
-    try:
-        del parts[-1]
-    except IndexError:
+def _join(terms, fz, joiner):
+    if not terms:
         raise EmptyQuery("No search terms")
-    return "({})".format("".join(parts))
+    sep = fz + (" {} ".format(joiner) if joiner else " ")
+    return "(" + sep.join(terms) + fz + ")"
 
 
 def and_(terms, escape=True, fuzzy=False, exact=False):
@@ -96,12 +118,215 @@ def or_(terms, escape=True, fuzzy=False, exact=False):
     return join(terms, escape, fuzzy, joiner="OR")
 
 
+class QueryBuilder:
+    """builds the same queries as join, and_, or_ and mkfield, but keeps
+    escaped terms, so terms which come up again (like the top candidates
+    for common words) are only escaped once. Terms can also be escaped up
+    front with escape_terms() and passed with ``escape=False``.
+    """
+
+    def __init__(self, maxsize=2 ** 16):
+        self.maxsize = maxsize
+        self.escaped = {}
+
+    def escape(self, term):
+        try:
+            return self.escaped[term]
+        except KeyError:
+            if len(self.escaped) >= self.maxsize:
+                self.escaped.clear()
+            escaped = self.escaped[term] = lucene_escape(term)
+            return escaped
+
+    def escape_terms(self, terms):
+        return [self.escape(t) for t in terms]
+
+    def join(self, terms, escape=True, fuzzy=False, exact=False, joiner=None):
+        if exact:
+            terms = ['"{}"'.format(t.replace('"', r"\"")) for t in terms]
+        elif escape:
+            terms = self.escape_terms(terms)
+        elif not isinstance(terms, list):
+            terms = list(terms)
+        return _join(terms, _fuzzy_suffix(fuzzy), joiner)
+
+    def and_(self, terms, escape=True, fuzzy=False, exact=False):
+        return self.join(terms, escape, fuzzy, joiner="AND")
+
+    def or_(self, terms, escape=True, fuzzy=False, exact=False):
+        return self.join(terms, escape, fuzzy, joiner="OR")
+
+    def field(
+        self,
+        fieldname,
+        terms,
+        escape=True,
+        fuzzy=False,
+        exact=False,
+        and_=False,
+    ):
+        """a whole field query, like mkfield(fieldname, join(terms, ...))"""
+        query = self.join(terms, escape, fuzzy, exact, "AND" if and_ else None)
+        return fieldname + ":" + query
+
+
 def mkfield(fieldname, query):
     return "{}:{}".format(fieldname, query)
 
 
+def grouped_request(queries, rows=10, **kwargs):
+    """JSON request body for running several queries in one request with
+    Solr's result grouping: each query is a ``group.query``, and the main
+    query is all of them OR'd together. Within each group, docs are ranked
+    by their score for the main query, not for the group's own query, so
+    the top ``rows`` docs for a query depend on the other queries in the
+    request.
+    """
+    return {
+        "query": " OR ".join("({})".format(q) for q in queries),
+        "limit": len(queries),
+        "params": {
+            "group": "true",
+            "group.query": list(queries),
+            "group.limit": rows,
+        },
+        **kwargs,
+    }
+
+
+def ungroup(queries, response):
+    """split the response to a grouped_request into one response per query,
+    in the same format run_query returns.
+    """
+    try:
+        grouped = response["grouped"]
+        return [grouped[q]["doclist"] for q in queries]
+    except KeyError:
+        raise QueryError(response, queries)
+
+
+_whitespace = re.compile(r"\s*")
+# characters which can continue a number, and "" for the end of the buffer.
+_number = set("0123456789.eE+-") | {""}
+
+
+class JSONReader:
+    """pulls JSON values from a stream of chunks (bytes or str) as they
+    arrive, so a big document can be walked without holding all of it.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.pos = 0
+
+    def more(self):
+        """read the next chunk into the buffer. False at the end."""
+        for chunk in self.chunks:
+            if isinstance(chunk, bytes):
+                chunk = self.decoder.decode(chunk)
+            if chunk:
+                self.buf = self.buf[self.pos :] + chunk
+                self.pos = 0
+                return True
+        return False
+
+    def peek(self):
+        """next character that isn't whitespace, or "" at the end"""
+        while True:
+            self.pos = _whitespace.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.more():
+                return ""
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise QueryError("expected one of {!r} in response".format(chars))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """decode the next whole value"""
+        self.peek()
+        while True:
+            try:
+                value, end = raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                end = None
+            # a number at the end of the buffer (or before a "." or "e") may
+            # continue in the next chunk. Valid JSON never ends with a value
+            # outside an object, so something else must follow.
+            if end is not None and self.buf[end : end + 1] not in _number:
+                self.pos = end
+                return value
+            if not self.more():
+                if end is None:
+                    raise QueryError("truncated response")
+                self.pos = end
+                return value
+
+    def keys(self):
+        """walk an object. Yields each key, after which the caller must
+        consume the value, with value() or by walking it.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def items(self):
+        """walk an array, yielding each element as it's decoded"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_response_docs(chunks, meta=None):
+    """yield the docs from the body of a Solr query response, given as an
+    iterable of chunks, one at a time while it's being read. Everything
+    else in the body is put in the ``meta`` dictionary, if given, e.g.
+    ``meta["response"]["numFound"]``.
+    """
+    reader = JSONReader(chunks)
+    meta = {} if meta is None else meta
+    for key in reader.keys():
+        if key != "response":
+            meta[key] = reader.value()
+            continue
+        response = meta["response"] = {}
+        for rkey in reader.keys():
+            if rkey == "docs":
+                yield from reader.items()
+            else:
+                response[rkey] = reader.value()
+    if "response" not in meta:
+        raise QueryError(meta)
+
+
+def select_url(url, fl=None):
+    if fl:
+        return url + "/query?fl={}".format(",".join(fl))
+    return url + "/query"
+
+
 class SolrCore:
     _rsess = None
+    # set to an arc.instrument.Instruments instance to time queries
+    instruments = None
 
     @property
     def rsess(self):
@@ -199,19 +424,85 @@ class SolrCore:
         """Run a Lucene query against the Solr database and return the docs
         array as a list.
         """
-        select_url = self.url + "/query"
-        if fl:
-            select_url += "?fl={}".format(",".join(fl))
+        if self.instruments is None:
+            return self._run_query(query, fl, **kwargs)
+        with self.instruments.timer("solr_query"):
+            return self._run_query(query, fl, **kwargs)
+
+    def _run_query(self, query: str, fl=None, **kwargs):
         try:
             resp = self.session.get(
-                select_url,
+                select_url(self.url, fl),
                 json={"query": query, **kwargs},
                 **self.requests_kws,
             )
-            return resp.json()["response"]
+            return loads(resp.content)["response"]
         except KeyError:
             raise QueryError(resp.text, query)
 
+    def iter_docs(
+        self, query: str, fl=None, meta=None, chunksize=2 ** 16, **kwargs
+    ):
+        """like run_query, but yields the docs one at a time while the
+        response is still being read, so memory doesn't grow with the
+        number of rows requested. The rest of the response goes in
+        ``meta``, as with iter_response_docs.
+        """
+        resp = self.session.get(
+            select_url(self.url, fl),
+            json={"query": query, **kwargs},
+            stream=True,
+            **self.requests_kws,
+        )
+        with contextlib.closing(resp):
+            try:
+                yield from iter_response_docs(
+                    resp.iter_content(chunksize), meta
+                )
+            except QueryError:
+                raise QueryError(resp.text, query)
+
+    def run_queries(
+        self,
+        queries: t.Iterable[str],
+        fl=None,
+        rows=10,
+        batchsize=50,
+        **kwargs
+    ):
+        """run many Lucene queries with one request per ``batchsize``
+        queries and return a list with a response for each, like the ones
+        from run_query. Each response has at most ``rows`` docs. Duplicate
+        queries are only sent once and share their response.
+
+        The docs for a query are the ones it matches, ranked by their score
+        for all the queries of its batch (see grouped_request). This is not
+        a drop-in for run_query where the ranking matters.
+        """
+        queries = list(queries)
+        unique = list(dict.fromkeys(queries))
+        responses = {}
+        for i in range(0, len(unique), batchsize):
+            batch = unique[i : i + batchsize]
+            if self.instruments is None:
+                results = self._run_batch(batch, fl, rows, **kwargs)
+            else:
+                with self.instruments.timer("solr_batch"):
+                    results = self._run_batch(batch, fl, rows, **kwargs)
+            responses.update(zip(batch, results))
+        return [responses[q] for q in queries]
+
+    def _run_batch(self, queries, fl=None, rows=10, **kwargs):
+        resp = self.session.post(
+            select_url(self.url, fl),
+            json=grouped_request(queries, rows, **kwargs),
+            **self.requests_kws,
+        )
+        try:
+            return ungroup(queries, loads(resp.content))
+        except QueryError:
+            raise QueryError(resp.text, queries)
+
     def update(self, message: dict):
         """general update command"""
         update_url = self.url + "/update"
@@ -233,15 +524,36 @@ async def run_query_async(
     """Run a Lucene query against the Solr database and return the docs
     array as a list.
     """
-    select_url = url + "/query"
-    if fl:
-        select_url += "?fl={}".format(",".join(fl))
     try:
         header = {"Content-Type": "application/json"}
         body = encode({"query": query, **kwargs})
         resp = await http.fetch(
-            select_url, method="POST", headers=header, body=body
+            select_url(url, fl), method="POST", headers=header, body=body
         )
-        return decode(resp.body.decode())["response"]
+        return loads(resp.body)["response"]
     except KeyError:
-        raise QueryError(resp.text, query)
+        raise QueryError(resp.body.decode(), query)
+
+
+async def run_queries_async(
+    url,
+    http: tornado.httpclient.AsyncHTTPClient,
+    queries: t.Sequence[str],
+    fl=None,
+    rows=10,
+    **kwargs
+):
+    """Run several Lucene queries in one request and return a list with a
+    response for each, a doclist dictionary like the ones from run_query.
+    The docs are ranked by all the queries together (see grouped_request),
+    so this is not a drop-in for run_query where the ranking matters.
+    """
+    header = {"Content-Type": "application/json"}
+    body = encode(grouped_request(queries, rows, **kwargs))
+    resp = await http.fetch(
+        select_url(url, fl), method="POST", headers=header, body=body
+    )
+    try:
+        return ungroup(queries, loads(resp.body))
+    except QueryError:
+        raise QueryError(resp.body.decode(), queries)
@@ -0,0 +1,184 @@
+"""
+Cached spell checking for generated Hebrew forms.
+
+The same candidate strings come up over and over again when converting a
+catalogue, so the results from the spell checker are memoized (and can be
+saved to disk between runs). The spell checker itself is pluggable. Hspell is
+used by default, but anything with ``check_word`` and ``linginfo`` methods will
+do, e.g. a WordListBackend.
+
+There is one default SpellChecker for the whole process (see get_checker),
+and it's used from the threads of a sessionpool.SessionPool, so lookups go
+through a lock.
+"""
+import collections
+import json
+import threading
+from pathlib import Path
+
+try:
+    from HspellPy import Hspell
+except ImportError as e:
+    Hspell = None
+    hspell_error = e
+
+# marks a result which hasn't been looked up yet. None is already used for
+# words the backend can't check at all (i.e. UnicodeEncodeError in Hspell).
+UNCHECKED = -1
+
+
+class WordListBackend:
+    """spell checking backend that accepts any word from a word list. Useful
+    where Hspell isn't installed, or with the NLI term dictionary.
+    """
+
+    def __init__(self, words=()):
+        self.words = set(words)
+
+    @classmethod
+    def from_file(cls, path):
+        """load words from a JSON file (a list, or a word frequency object
+        like the term dictionaries) or a text file with one word per line.
+        """
+        path = Path(path)
+        with path.open() as fh:
+            if path.suffix == ".json":
+                return cls(json.load(fh))
+            return cls(filter(None, map(str.strip, fh)))
+
+    def check_word(self, word):
+        return word in self.words
+
+    def linginfo(self, word):
+        return word in self.words
+
+
+def hspell_backend():
+    if Hspell is None:
+        raise hspell_error
+    return Hspell(linguistics=True)
+
+
+class SpellChecker:
+    """memoizing wrapper around a spell checking backend."""
+
+    def __init__(self, backend=None, maxsize=2 ** 17, path=None):
+        """
+        - backend: object with ``check_word`` and ``linginfo`` methods.
+          Hspell if not specified.
+        - maxsize: maximum number of words to keep results for. The least
+          recently used words are dropped first.
+        - path: JSON file where results are persisted between runs. Results
+          are loaded from it if it exists.
+        """
+        self.backend = backend or hspell_backend()
+        self.maxsize = maxsize
+        self.path = Path(path).expanduser() if path else None
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # for the cache, the counters and the backend
+        self.lock = threading.Lock()
+        if self.path and self.path.exists():
+            self.load()
+
+    def _lookup(self, word, index):
+        with self.lock:
+            return self._lookup_unlocked(word, index)
+
+    def _lookup_unlocked(self, word, index):
+        cache = self.cache
+        try:
+            entry = cache[word]
+            cache.move_to_end(word)
+        except KeyError:
+            entry = cache[word] = [UNCHECKED, UNCHECKED]
+            if len(cache) > self.maxsize:
+                cache.popitem(last=False)
+
+        result = entry[index]
+        if result != UNCHECKED:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        backend = self.backend
+        try:
+            # known() only needs linginfo if the word was checked before.
+            result = entry[0]
+            if result == UNCHECKED:
+                result = entry[0] = bool(backend.check_word(word))
+            if index and result:
+                result = bool(backend.linginfo(word))
+        except UnicodeEncodeError:
+            result = entry[0] = None
+        entry[index] = result
+        return result
+
+    def check(self, word):
+        """True if the word is spelled correctly, None if the backend can't
+        check it.
+        """
+        return self._lookup(word, 0)
+
+    def known(self, word):
+        """like check(), but the backend must also have linguistic info
+        for the word.
+        """
+        return self._lookup(word, 1)
+
+    def check_many(self, words, linginfo=False):
+        """check an iterable of words. Returns a dictionary of results with
+        the words as keys.
+        """
+        lookup = self.known if linginfo else self.check
+        return {w: lookup(w) for w in words}
+
+    def warm(self, termdict, n=None):
+        """pre-load results for the ``n`` most frequent words in a term
+        dictionary (a Counter, like Session.add_termdict returns). Never loads
+        more words than fit in the cache.
+        """
+        n = min(n or self.maxsize, self.maxsize)
+        for word, _ in termdict.most_common(n):
+            self.known(word)
+
+    def load(self, path=None):
+        with Path(path or self.path).open() as fh:
+            entries = json.load(fh)
+        with self.lock:
+            for word, entry in entries.items():
+                self.cache[word] = entry
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def save(self, path=None):
+        with self.lock:
+            cache = dict(self.cache)
+        with Path(path or self.path).open("w") as fh:
+            json.dump(cache, fh, ensure_ascii=False)
+
+
+_checker = None
+_checker_lock = threading.Lock()
+
+
+def get_checker():
+    """return the default SpellChecker, creating one with Hspell if
+    necessary.
+    """
+    global _checker
+    if _checker is None:
+        with _checker_lock:
+            if _checker is None:
+                _checker = SpellChecker()
+    return _checker
+
+
+def set_checker(checker):
+    """replace the default SpellChecker used by arc.decode and
+    arc.cacheutils.
+    """
+    global _checker
+    _checker = checker
+    return checker
@@ -1,9 +1,14 @@
 import argparse
 import collections
+import heapq
+import itertools
 import json
 import sys
+import time
 from arc import config
 from . import cacheutils as cu
+from . import decode
+from .candidates import Candidates
 
 CFG = config.Config()
 
@@ -35,6 +40,184 @@ def use_dict(rlist, dictionary):
         rlist.sort(reverse=True)
 
 
+STAGES = "chunking", "decoding", "caching", "stats"
+
+
+class LineTimes:
+    """time spent on each processing stage for one line of input, along
+    with the lengths of the replists generated for it.
+    """
+
+    __slots__ = "line", "stages", "sizes"
+
+    def __init__(self, line):
+        self.line = line
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.sizes = []
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def __lt__(self, other):
+        return self.total < other.total
+
+
+class SlowestLines:
+    """keeps the n slowest LineTimes it's given, plus totals for all
+    lines.
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.heap = []
+        self.lines = 0
+        self.stages = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, times: LineTimes):
+        self.lines += 1
+        for stage, seconds in times.stages.items():
+            self.stages[stage] += seconds
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, times)
+        elif self.n:
+            heapq.heappushpop(self.heap, times)
+
+    def report(self, file=sys.stderr):
+        def ms(seconds):
+            return "%.2f" % (seconds * 1000)
+
+        total = sum(self.stages.values())
+        print("# %d lines, %s ms total" % (self.lines, ms(total)), file=file)
+        print(
+            "#",
+            *("%s=%s" % (s, ms(self.stages[s])) for s in STAGES),
+            file=file,
+        )
+        print("# slowest lines (ms):", file=file)
+        print("total", *STAGES, "replists", "line", sep="\t", file=file)
+        for times in sorted(self.heap, reverse=True):
+            print(
+                ms(times.total),
+                *(ms(times.stages[s]) for s in STAGES),
+                ",".join(map(str, times.sizes)),
+                times.line,
+                sep="\t",
+                file=file,
+            )
+
+
+class LineConverter:
+    """converts lines to dictionaries with the top candidates for each chunk,
+    for machine-readable output.
+    """
+
+    def __init__(
+        self,
+        standard="old",
+        spelling=False,
+        cache=False,
+        crop=0,
+        probabilities=False,
+    ):
+        self.decoder = CFG.from_schema(
+            standard, fix_numerals=True, spellcheck=spelling
+        )
+        if cache:
+            self.caches = CFG.get_caches("LOC/ALA", "phonological")
+        else:
+            self.caches = None
+        self.crop = crop or None
+        self.probabilities = probabilities
+
+    def convert(self, line):
+        decoder = self.decoder
+        try:
+            chunks = decoder.make_chunks(line)
+        except (IndexError, KeyError, ValueError) as e:
+            return {"input": line, "error": repr(e)}
+
+        # only the top candidates are needed, so use the compact form and
+        # don't create Replacement objects for every combination.
+        out = []
+        for chunk in chunks:
+            try:
+                if self.caches:
+                    word, _ = cu.match_cached(
+                        chunk, decoder, *self.caches, compact=True
+                    )
+                elif isinstance(chunk, decode.Chunk):
+                    word = chunk.candidates
+                else:
+                    word = Candidates.from_replist(
+                        chunk.heb, decoder.strings
+                    )
+            except (IndexError, KeyError, ValueError) as e:
+                return {"input": line, "error": repr(e)}
+            if self.probabilities:
+                word = word.makestat()
+            out.append(
+                {
+                    "rom": chunk.rom,
+                    "candidates": [
+                        [w.heb, w.weight] for w in word.top(self.crop)
+                    ],
+                }
+            )
+        return {"input": line, "chunks": out}
+
+    def convert_batch(self, lines):
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        return [encode(self.convert(line)) for line in lines]
+
+
+# converter for the current worker process
+_converter = None
+
+
+def init_converter(kwargs):
+    global _converter
+    _converter = LineConverter(**kwargs)
+
+
+def convert_batch(lines):
+    return _converter.convert_batch(lines)
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def convert_stream(lines, converter_kwargs, batch_size=500, jobs=1):
+    """yields batches of lines of JSON for an iterable of input lines.
+    ``jobs`` worker processes each convert one batch at a time. No more than
+    two batches per worker are read ahead, so memory use doesn't depend on
+    the size of the input.
+    """
+    if jobs <= 1:
+        init_converter(converter_kwargs)
+        yield from map(convert_batch, batches(lines, batch_size))
+        return
+
+    import multiprocessing
+
+    with multiprocessing.Pool(
+        jobs, init_converter, (converter_kwargs,)
+    ) as pool:
+        pending = collections.deque()
+        for batch in batches(lines, batch_size):
+            pending.append(pool.apply_async(convert_batch, (batch,)))
+            if len(pending) >= jobs * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
 def main():
     ap = argparse.ArgumentParser(description="show some Hebrew things")
     add = ap.add_argument
@@ -52,46 +235,156 @@ def main():
     )
     add("--debug", "-d", action="store_true", help="show debugging info")
     add("--cache", "-C", action="store_true", help="use the cached forms")
-    add("--dictionary", nargs="*", type=lambda x: json.load(open(x)))
+    add("--dictionary", nargs="*")
     add("--numbers", "-N", action="store_true", help='show "secret" numbers')
-    add("--crop", "-c", type=int, default=0)
+    add(
+        "--crop",
+        "-c",
+        type=int,
+        default=0,
+        help="only show the top N candidates for each chunk",
+    )
     add("--spelling", "-s", action="store_true")
     add("--sep", default="│")
     add("--probabilites", "-p", action="store_true")
     add("--standard", default="old")
     add("--loc", "-l", action="store_true")
+    add(
+        "--profile",
+        action="store_true",
+        help="time each line and report the slowest ones on stderr",
+    )
+    add(
+        "--slowest",
+        type=int,
+        metavar="N",
+        help="number of slow lines to report (default: 10). implies "
+        "--profile",
+    )
+    add("--pstats", metavar="FILE", help="dump cProfile stats to FILE")
+    add(
+        "--format",
+        choices=("text", "jsonl"),
+        default="text",
+        help="jsonl: print one JSON object with the candidates for each "
+        "chunk per input line. Use --crop to limit the candidates.",
+    )
+    add(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="number of worker processes for jsonl output",
+    )
+    add(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="lines per batch sent to workers for jsonl output",
+    )
     args = ap.parse_args()
+    if args.batch_size < 1:
+        ap.error("--batch-size must be at least 1")
+    if args.format == "jsonl" and (
+        args.profile or args.slowest or args.pstats
+    ):
+        ap.error("--profile, --slowest and --pstats need --format text")
 
     if args.loc:
         args.standard = "new"
 
+    if args.format == "jsonl":
+        convert_jsonl(args)
+    elif args.pstats:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            convert_lines(args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(args.pstats)
+    else:
+        convert_lines(args)
+
+
+def convert_jsonl(args):
+    converter_kwargs = dict(
+        standard=args.standard,
+        spelling=args.spelling,
+        cache=args.cache,
+        crop=args.crop,
+        probabilities=args.probabilites,
+    )
+    lines = map(str.rstrip, sys.stdin)
+    for batch in convert_stream(
+        lines, converter_kwargs, args.batch_size, args.jobs
+    ):
+        sys.stdout.write("\n".join(batch) + "\n")
+
+
+def convert_lines(args):
     decoder = CFG.from_schema(
         args.standard, fix_numerals=True, spellcheck=args.spelling
     )
 
     if args.dictionary:
         dictionary = collections.Counter()
-        for d in args.dictionary:
-            dictionary.update(d)
+        for path in args.dictionary:
+            with open(path) as fh:
+                dictionary.update(json.load(fh))
     else:
         dictionary = None
 
     if args.cache:
         loccache, phoncache = CFG.get_caches("LOC/ALA", "phonological")
 
+    if args.profile or args.slowest is not None:
+        slowest = SlowestLines(10 if args.slowest is None else args.slowest)
+    else:
+        slowest = None
+    clock = time.perf_counter
+
     for t in map(str.rstrip, sys.stdin):
         print(t)
         print()
-        for chunk in decoder.make_chunks(t):
+        times = stages = None
+        if slowest is not None:
+            times = LineTimes(t)
+            stages = times.stages
+            start = clock()
+        chunks = decoder.make_chunks(t)
+        if stages is not None:
+            stages["chunking"] += clock() - start
+        for chunk in chunks:
             print(chunk.rom)
             print("-" * len(chunk.rom))
+            if stages is not None:
+                start = clock()
             if args.cache:
+                if stages is not None and isinstance(chunk, decode.Chunk):
+                    # decode before matching so it can be timed separately
+                    chunk.base.stripped_heb
+                    now = clock()
+                    stages["decoding"] += now - start
+                    start = now
                 word, _ = cu.match_cached(chunk, decoder, loccache, phoncache)
+                if stages is not None:
+                    stages["caching"] += clock() - start
             else:
                 word = chunk.heb
+                if stages is not None:
+                    stages["decoding"] += clock() - start
             # use_dict(word, dictionary)
             if args.probabilites:
+                if stages is not None:
+                    start = clock()
                 word = word.makestat()
+                if stages is not None:
+                    stages["stats"] += clock() - start
+            if times is not None:
+                times.sizes.append(len(word))
             for i, w in enumerate(word):
                 if args.crop and args.crop == i:
                     break
@@ -111,6 +404,11 @@ def main():
                     print("  " + args.sep.join(rom for rom, _ in atoms))
                     print("  " + args.sep.join(heb for _, heb in atoms) + "\n")
             print()
+        if times is not None:
+            slowest.add(times)
+
+    if slowest is not None:
+        slowest.report()
 
 
 if __name__ == "__main__":
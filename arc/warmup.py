@@ -0,0 +1,177 @@
+"""
+Warming up a Session before it starts converting.
+
+A new Session decodes every token for the first time and looks every form
+up in the cache database, so the first few thousand titles are much slower
+than the rest. A few thousand tokens make up most of the words in the
+catalogue, so decoding the most frequent ones ahead of time and fetching
+their cached forms in bulk gets most of the way to steady state.
+
+Tokens are counted in the titles of the checked records in the ARC database
+or of the records in a PICA dump, and the most frequent ones are saved to a
+warm-cache file. Session.warm loads it.
+
+    arc-warm-cache --checked -n 20000 -o warm.json
+    arc-warm-cache --pica dump.pp -o warm.json
+"""
+import argparse
+import collections
+import json
+import sys
+import time
+from pathlib import Path
+from . import cacheutils as cu
+from . import decode
+
+# exceptions from decoding a line, as in util.LineConverter
+DECODE_ERRORS = IndexError, KeyError, ValueError
+
+
+def count_tokens(session, lines, counts=None):
+    """Counter of (decoder name, token) for the base word of each chunk in
+    an iterable of lines, with the decoder Session.pickdecoder picks for
+    the line. Tokens are stripped, as they're kept in Decoder.token_cache.
+    """
+    counts = collections.Counter() if counts is None else counts
+    for line in lines:
+        try:
+            decoder, _ = session.pickdecoder(line)
+            chunks = decoder.make_chunks(line)
+        except DECODE_ERRORS:
+            continue
+        name = decoder.name
+        counts.update(
+            (name, chunk.base.split[1])
+            for chunk in chunks
+            if isinstance(chunk, decode.Chunk)
+        )
+    return counts
+
+
+def top_tokens(counts, n=10000):
+    """dictionary of the ``n`` most frequent tokens for each decoder, most
+    frequent first.
+    """
+    top = {}
+    for (name, token), _ in counts.most_common(n):
+        top.setdefault(name, []).append(token)
+    return top
+
+
+def save(top, path):
+    with Path(path).open("w") as fh:
+        json.dump(top, fh, ensure_ascii=False)
+
+
+def load(path):
+    with Path(path).open() as fh:
+        return json.load(fh)
+
+
+def warm(session, top, prefetch=True):
+    """decode the tokens in a dictionary from top_tokens with the session's
+    decoders. With ``prefetch``, the LOC/ALA and phonological forms of all
+    their candidates are also converted and looked up in the caches.
+    Tokens for decoders the session doesn't have are skipped. Returns a
+    Counter with the numbers of tokens and forms loaded.
+    """
+    stats = collections.Counter()
+    loc_forms = {}
+    phon_forms = {}
+    for name, tokens in top.items():
+        decoder = session.decoders.get(name)
+        if decoder is None:
+            continue
+        stats["tokens"] += decoder.warm(tokens)
+        if not prefetch:
+            continue
+        cache = decoder.token_cache
+        for token in tokens:
+            replist = cache.get(token)
+            if replist is not None:
+                loc_keys, phon_keys = cu.collect_keys(replist, decoder)
+                loc_forms.update(dict.fromkeys(loc_keys))
+                phon_forms.update(dict.fromkeys(phon_keys))
+    if prefetch:
+        stats["loc"] = session.caches.loc.prefetch(loc_forms)
+        stats["phon"] = session.caches.phon.prefetch(phon_forms)
+    return stats
+
+
+def pica_titles(path):
+    """the romanized titles of the records in a PICA dump which need to be
+    converted.
+    """
+    from . import picaqueries
+
+    for batch in picaqueries.read_batches(path):
+        needed = picaqueries.needs_conversion_many(batch)
+        for record, needs_conversion in zip(batch, needed):
+            if not needs_conversion:
+                continue
+            try:
+                yield picaqueries.gettranstitle(record).joined
+            except (picaqueries.NoMainTitle, KeyError):
+                continue
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="count the most frequent tokens in catalogue titles "
+        "and write a warm-cache file for Session.warm"
+    )
+    source = ap.add_mutually_exclusive_group(required=True)
+    source.add_argument(
+        "--checked",
+        action="store_true",
+        help="use the titles of the checked records in the ARC database",
+    )
+    source.add_argument("--pica", metavar="FILE", help="a PICA dump")
+    source.add_argument(
+        "--titles",
+        metavar="FILE",
+        help="romanized titles, one per line ('-' for stdin)",
+    )
+    ap.add_argument("--output", "-o", required=True, help="file to write")
+    ap.add_argument("--config", help="config file (default: the user's)")
+    ap.add_argument(
+        "--tokens", "-n", type=int, default=10000, help="tokens to keep"
+    )
+    args = ap.parse_args()
+
+    from . import config
+
+    session = config.Session(config.Config(args.config))
+    session.add_decoders(["old", "new"], fix_numerals=True)
+    if "pi" in session.config.schemas:
+        session.add_decoder("pi", fix_numerals=True)
+    else:
+        # there's no PI profile in data/. The old one is the closest thing.
+        session.decoders.pi = session.decoders.old
+
+    if args.checked:
+        lines = session.records.checked_titles()
+    elif args.pica:
+        lines = pica_titles(args.pica)
+    elif args.titles == "-":
+        lines = (line.rstrip("\n") for line in sys.stdin)
+    else:
+        lines = (line.rstrip("\n") for line in open(args.titles))
+
+    start = time.perf_counter()
+    counts = count_tokens(session, (line for line in lines if line))
+    top = top_tokens(counts, args.tokens)
+    save(top, args.output)
+    print(
+        "{} distinct tokens counted in {:.1f}s, {} written to {}".format(
+            len(counts),
+            time.perf_counter() - start,
+            sum(map(len, top.values())),
+            args.output,
+        ),
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
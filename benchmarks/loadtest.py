@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Load test for arc-server (arc/server.py).
+
+Starts a local stand-in for Solr (arc.localsolr) with the top guess for
+every title in the corpus, and the server in a subprocess with an empty
+cache database. Then ``--concurrency`` clients send requests with
+titles from the corpus as fast as they get answers. Throughput and latency
+percentiles are reported, and the exit status is 1 if the p99 latency or
+the throughput miss their targets:
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --endpoint match --concurrency 64
+    python benchmarks/loadtest.py --batch-size 1   # no batching
+
+The targets are met on a single CPU core running the server, the stand-in
+and the clients together, with the default options.
+"""
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from run import DATA, ROOT, load_profile, read_corpus
+
+import yaml
+
+# (p99 latency in ms, requests per second) for each endpoint
+TARGETS = {"convert": (250, 400), "match": (300, 300)}
+
+
+def local_solr(corpus, delay):
+    """start a stand-in Solr server with a document for the top guess of
+    every title and return its URL (without the core name).
+    """
+    from arc import localsolr
+    from arc.decode import Decoder
+
+    decoder = Decoder(load_profile("old"), fix_numerals=True)
+    docs = []
+    for i, line in enumerate(corpus):
+        words = [str(rlist[0]) for rlist in decoder.make_chunks(line).heb]
+        docs.append({"001_txt": str(i), "245_a_txt": " ".join(words)})
+
+    core = localsolr.LocalCore(docs, {"alltitles": ["245_a_txt"]})
+    server = localsolr.serve({"nlibooks": core}, port=0, delay=delay)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://{}:{}".format(*server.server_address)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, solr_url):
+    tmp = Path(tempfile.mkdtemp())
+    config = str(tmp / "config.yml")
+    with open(config, "w") as fh:
+        yaml.safe_dump(
+            {"cache_db": str(tmp / "cache.db"), "schemas": str(DATA)}, fh
+        )
+    port = free_port()
+    cmd = [
+        sys.executable,
+        "-m",
+        "arc.server",
+        "--config",
+        config,
+        "--port",
+        str(port),
+        "--solr-url",
+        solr_url,
+        "--sessions",
+        str(args.sessions),
+        "--batch-size",
+        str(args.batch_size),
+        "--batch-delay",
+        str(args.batch_delay),
+    ]
+    proc = subprocess.Popen(cmd, cwd=str(ROOT), stdout=subprocess.PIPE)
+    line = proc.stdout.readline()
+    if not line.startswith(b"listening"):
+        proc.kill()
+        sys.exit("the server didn't start")
+    return proc, "http://127.0.0.1:%d" % port
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_load(url, bodies, concurrency):
+    """send the request bodies from ``concurrency`` clients and return the
+    latency of each successful request, the number of errors and the wall
+    time.
+    """
+    from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+    http = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    pending = iter(bodies)
+    latencies = []
+    errors = 0
+
+    async def client():
+        nonlocal errors
+        for body in pending:
+            start = time.perf_counter()
+            try:
+                await http.fetch(url, method="POST", body=body)
+            except (HTTPClientError, OSError):
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    http.close()
+    return latencies, errors, elapsed
+
+
+def fetch_stats(url):
+    import urllib.request
+
+    with urllib.request.urlopen(url + "/stats") as resp:
+        return json.loads(resp.read())
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--endpoint", choices=sorted(TARGETS), default="convert")
+    ap.add_argument("-n", "--requests", type=int, default=5000)
+    ap.add_argument("-c", "--concurrency", type=int, default=32)
+    ap.add_argument("--sessions", type=int, default=2)
+    ap.add_argument("--batch-size", type=int, default=32)
+    ap.add_argument(
+        "--batch-delay", type=float, default=2, help="in ms (default: 2)"
+    )
+    ap.add_argument(
+        "--solr-delay",
+        type=float,
+        default=2,
+        help="added to every Solr request, in ms (default: 2)",
+    )
+    ap.add_argument("--target-p99", type=float, help="in ms")
+    ap.add_argument("--target-qps", type=float)
+    args = ap.parse_args()
+    target_p99, target_qps = TARGETS[args.endpoint]
+    target_p99 = args.target_p99 or target_p99
+    target_qps = args.target_qps or target_qps
+
+    corpus = read_corpus()
+    solr_url = local_solr(corpus, args.solr_delay / 1000)
+    proc, url = start_server(args, solr_url)
+    try:
+        if args.endpoint == "convert":
+            bodies = [json.dumps({"text": line}) for line in corpus]
+        else:
+            bodies = [json.dumps({"title": line}) for line in corpus]
+        endpoint = url + "/" + args.endpoint
+        # one pass over the corpus first, so the server is at steady state
+        asyncio.run(run_load(endpoint, bodies, args.concurrency))
+        before = fetch_stats(url)[args.endpoint]
+        requests = (bodies * (args.requests // len(bodies) + 1))[
+            : args.requests
+        ]
+        latencies, errors, elapsed = asyncio.run(
+            run_load(endpoint, requests, args.concurrency)
+        )
+        after = fetch_stats(url)[args.endpoint]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies.sort()
+    qps = len(latencies) / elapsed
+    p99 = percentile(latencies, 0.99) * 1000
+    batches = after.get("batches", 0) - before.get("batches", 0)
+    items = after.get("items", 0) - before.get("items", 0)
+    print("endpoint     /{}".format(args.endpoint))
+    print("requests     {} ({} errors)".format(len(latencies), errors))
+    print("concurrency  {}".format(args.concurrency))
+    print("batch size   {:.1f} on average".format(items / (batches or 1)))
+    print("throughput   {:.0f} req/s (target {:.0f})".format(qps, target_qps))
+    for name, q in (("p50", 0.5), ("p90", 0.9)):
+        ms = percentile(latencies, q) * 1000
+        print("{:12} {:.1f}ms".format(name, ms))
+    print("p99          {:.1f}ms (target {:.0f}ms)".format(p99, target_p99))
+    print("max          {:.1f}ms".format(latencies[-1] * 1000))
+
+    passed = not errors and p99 <= target_p99 and qps >= target_qps
+    print("PASS" if passed else "FAIL")
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
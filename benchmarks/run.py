@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""Throughput benchmarks for the decoders, the caches and result ranking.
+
+Each benchmark runs over the bundled title corpus (titles.txt) and reports
+lines (or tokens) per second. Results are written as JSON so runs on
+different commits can be compared:
+
+    python benchmarks/run.py -o before.json
+    git checkout something-else
+    python benchmarks/run.py -o after.json --compare before.json
+
+Benchmarks which need a library that isn't installed are reported as skipped.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+HERE = Path(__file__).absolute().parent
+ROOT = HERE.parent
+DATA = ROOT / "data"
+sys.path.insert(0, str(ROOT))
+
+import yaml  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """register a benchmark. The function takes the corpus and returns a
+    callable to time and the number of items the callable processes.
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def read_corpus(name="titles.txt"):
+    with (HERE / name).open() as fh:
+        return [line.rstrip("\n") for line in fh if line.strip()]
+
+
+def load_profile(name):
+    with (DATA / (name + ".yml")).open() as fh:
+        return yaml.safe_load(fh)
+
+
+def mksession():
+    """build a Session with an in-memory cache database and the old and new
+    decoders.
+    """
+    from arc import config
+
+    # the config file is only read when Config is created. deromanize
+    # takes "sqlite://" for a file path, so ":memory:" it is.
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "config.yml"
+        with path.open("w") as fh:
+            yaml.safe_dump({"cache_db": ":memory:", "schemas": str(DATA)}, fh)
+        session = config.Session(config.Config(path))
+    session.add_decoders(["old", "new"], fix_numerals=True)
+    # there's no PI profile in data/. The old one is the closest thing.
+    session.decoders.pi = session.decoders.old
+    return session
+
+
+def fill_caches(session, corpus):
+    """put the top guess for every word of every other line into the loc
+    and phon caches, so usecache gets a mix of hits and misses.
+    """
+    from arc import cacheutils as cu
+
+    loc, phon = session.caches.loc, session.caches.phon
+    with loc:
+        for line in corpus[::2]:
+            chunks, _ = session.getchunks(line)
+            for chunk in chunks.get_word_chunks():
+                rep = chunk.base.stripped_heb[0]
+                if len(rep.key) <= 1:
+                    continue
+                locform = chunks.decoder.get_loc(rep)
+                phonform = cu.loc2phon(locform)
+                # deromanize can't store an empty form
+                if not locform or not phonform:
+                    continue
+                loc.add(locform, str(rep))
+                phon.add(phonform, str(rep))
+
+
+def chunk_and_decode(decoder, corpus):
+    def run():
+        for line in corpus:
+            decoder.make_chunks(line).heb
+
+    return run, len(corpus)
+
+
+@benchmark
+def decode_old(corpus):
+    from arc.decode import Decoder
+
+    profile = load_profile("old")
+    decoder = Decoder(profile, fix_numerals=True, fix_k=profile.get("fix_k"))
+    return chunk_and_decode(decoder, corpus)
+
+
+@benchmark
+def decode_new(corpus):
+    from arc.decode import Decoder
+
+    decoder = Decoder(load_profile("new"), fix_numerals=True)
+    return chunk_and_decode(decoder, corpus)
+
+
+@benchmark
+def decode_gk(corpus):
+    # gk.yml has no prefix or LOC data, so arc.decode.Decoder can't load
+    # it. This times the deromanize decoding each Word does instead, on a
+    # token basis.
+    import deromanize as dr
+
+    keys = dr.KeyGenerator(load_profile("gk"))
+    tokens = [w for line in read_corpus("titles-gk.txt") for w in line.split()]
+
+    def run():
+        for token in tokens:
+            dr.front_mid_end_decode(keys, token)
+
+    return run, len(tokens)
+
+
+def decoder_startup(name, compiled):
+    """build decoders for a profile, from the YAML or from a copy compiled
+    with arc.profiles in a temporary directory.
+    """
+    from arc import profiles
+    from arc.decode import Decoder
+
+    tmp = tempfile.TemporaryDirectory()
+    source = Path(tmp.name) / (name + ".yml")
+    source.write_bytes((DATA / (name + ".yml")).read_bytes())
+    keygen = profiles.expand_profile(load_profile(name))
+    profiles.write_compiled(keygen, source)
+
+    def run():
+        if compiled:
+            keys = profiles.load_compiled(source)
+            Decoder(keys.profile, fix_numerals=True, keys=keys)
+        else:
+            Decoder(load_profile(name), fix_numerals=True)
+
+    # the directory is removed with the benchmark
+    run.tmp = tmp
+    return run, 1
+
+
+@benchmark
+def startup_new(corpus):
+    return decoder_startup("new", compiled=False)
+
+
+@benchmark
+def startup_new_compiled(corpus):
+    return decoder_startup("new", compiled=True)
+
+
+@benchmark
+def date_years(corpus):
+    """normalized years for date strings, as for records and Solr results.
+    Memoized results are cleared on each run, so only repeats within the
+    run are cached.
+    """
+    from arc import dates
+
+    datestrings = read_corpus("dates.txt") * 20
+
+    def run():
+        for func in (dates.token2year, dates.parse_date, dates.normyears):
+            func.cache_clear()
+        for datestring in datestrings:
+            dates.normyears(datestring)
+
+    return run, len(datestrings)
+
+
+@benchmark
+def loc_convert(corpus):
+    """LOC/ALA forms for every candidate of every chunk, as collect_keys and
+    form_builder need them. Memoized keyvalues are cleared on each run;
+    converted pairs are kept, like in a long-running session.
+    """
+    from arc.decode import Decoder
+
+    decoder = Decoder(load_profile("old"), fix_numerals=True)
+    reps = [
+        rep
+        for line in corpus
+        for rlist in decoder.make_chunks(line).heb
+        for rep in rlist.data
+    ] * 50
+    get_loc = decoder.get_loc
+
+    def run():
+        get_loc.cache.clear()
+        for rep in reps:
+            get_loc(rep)
+
+    return run, len(reps)
+
+
+@benchmark
+def nli_format(corpus):
+    """fix_nli_format on the regression corpus in nli_format.jsonl, which
+    has NLI-style strings with the output the original regex pipeline gave
+    for them. Fails if any output differs.
+    """
+    from arc.nlitools import prepare
+
+    with (HERE / "nli_format.jsonl").open() as fh:
+        cases = [json.loads(line) for line in fh]
+    for text, expected in cases:
+        result = prepare.fix_nli_format(text)
+        if result != expected:
+            raise ValueError(
+                "fix_nli_format({!r}) gave {!r}, expected {!r}".format(
+                    text, result, expected
+                )
+            )
+    texts = [text for text, _ in cases] * 20
+
+    def run():
+        for text in texts:
+            prepare.fix_nli_format(text)
+
+    return run, len(texts)
+
+
+@benchmark
+def query_build(corpus):
+    """fuzzy title queries from the top five candidates of every word, the
+    way solrmarc.getqueryparts builds them.
+    """
+    from arc import solrtools as st
+    from arc.decode import Decoder
+
+    decoder = Decoder(load_profile("old"), fix_numerals=True)
+    titles = []
+    for line in corpus:
+        words = (
+            [str(rep).replace("-", "") for rep in rlist[:5]]
+            for rlist in decoder.make_chunks(line).heb
+        )
+        titles.append([w for w in words if any(w)])
+    builder = st.QueryBuilder()
+
+    def run():
+        for title in titles:
+            parts = [builder.or_(filter(None, t), fuzzy=True) for t in title]
+            builder.and_(parts, escape=False)
+
+    return run, len(titles)
+
+
+@benchmark
+def line_filters(corpus):
+    from arc import filters
+
+    props = (
+        "old new only_new only_pi only_old ascii_letters english_y foreign "
+        "yiddish_ending transliteration"
+    ).split()
+
+    def run():
+        for text in corpus:
+            line = filters.Line(text)
+            for prop in props:
+                line.has(prop)
+
+    return run, len(corpus)
+
+
+@benchmark
+def session_pickdecoder(corpus):
+    session = mksession()
+
+    def run():
+        for line in corpus:
+            session.pickdecoder(line)
+
+    return run, len(corpus)
+
+
+@benchmark
+def session_pickdecoder_cold(corpus):
+    """session_pickdecoder with the memos emptied before each run"""
+    session = mksession()
+
+    def run():
+        session.pick_cache.clear()
+        session.charset_cache.clear()
+        for line in corpus:
+            session.pickdecoder(line)
+
+    return run, len(corpus)
+
+
+@benchmark
+def session_usecache(corpus):
+    """getchunks + usecache with half of the corpus in the caches."""
+    session = mksession()
+    fill_caches(session, corpus)
+
+    def run():
+        for line in corpus:
+            chunks, _ = session.getchunks(line)
+            session.usecache(chunks)
+
+    return run, len(corpus)
+
+
+def reset_session(session):
+    """empty the token caches and lookup memos, as in a new session"""
+    for decoder in set(session.decoders.values()):
+        decoder.clear_caches()
+    session.caches.loc.clear()
+    session.caches.phon.clear()
+    session.pick_cache.clear()
+    session.charset_cache.clear()
+
+
+@benchmark
+def session_usecache_cold(corpus):
+    """session_usecache on a first pass, with nothing decoded or looked up
+    yet.
+    """
+    session = mksession()
+    fill_caches(session, corpus)
+
+    def run():
+        reset_session(session)
+        for line in corpus:
+            chunks, _ = session.getchunks(line)
+            session.usecache(chunks)
+
+    return run, len(corpus)
+
+
+@benchmark
+def session_usecache_warmed(corpus):
+    """session_usecache on a first pass after Session.warm with the tokens
+    of the corpus. The time includes the warm-up.
+    """
+    from arc import warmup
+
+    session = mksession()
+    fill_caches(session, corpus)
+    top = warmup.top_tokens(warmup.count_tokens(session, corpus))
+
+    def run():
+        reset_session(session)
+        session.warm(top=top)
+        for line in corpus:
+            chunks, _ = session.getchunks(line)
+            session.usecache(chunks)
+
+    return run, len(corpus)
+
+
+@benchmark
+def rank_results2(corpus):
+    from arc.decode import Decoder
+    from arc.picaqueries import Title
+    from arc.nlitools import solrmarc
+
+    decoder = Decoder(load_profile("old"), fix_numerals=True)
+    cases = []
+    titles = []
+    for line in corpus:
+        rlists = [
+            [str(rep) for rep in rlist[:5]]
+            for rlist in decoder.make_chunks(line).heb
+        ]
+        cases.append(solrmarc.RepTitle(rlists, None, None))
+        titles.append(" ".join(rlist[0] for rlist in rlists))
+
+    def mkdoc(title):
+        return {
+            "title": [Title(title, None, None)],
+            "creator": ["כהן, משה"],
+            "date": ["תש״י"],
+        }
+
+    # for every title: the exact top guess, a title which differs in one
+    # word and three unrelated titles from the corpus.
+    docs = []
+    for i, (case, title) in enumerate(zip(cases, titles)):
+        words = title.split()
+        if len(case.main[-1]) > 1:
+            words[-1] = case.main[-1][1]
+        others = [titles[(i + n) % len(titles)] for n in (7, 13, 29)]
+        docs.append(list(map(mkdoc, [title, " ".join(words), *others])))
+
+    def run():
+        for case, results in zip(cases, docs):
+            solrmarc.rank_results2(
+                ["כהן, משה"], [], None, [], [5710], case, results
+            )
+
+    return run, len(cases)
+
+
+def local_solr(corpus):
+    """start a local Solr stand-in with the top guess for every title and
+    return a SolrCore for it and fuzzy title queries like getdocs sends. The
+    server adds 2ms to every request, about a round trip on a LAN.
+    """
+    import threading
+    from arc import localsolr, solrtools as st
+    from arc.decode import Decoder
+
+    decoder = Decoder(load_profile("old"), fix_numerals=True)
+    docs = []
+    queries = []
+    for i, line in enumerate(corpus):
+        rlists = [
+            [str(rep).replace("-", "") for rep in rlist[:3]]
+            for rlist in decoder.make_chunks(line).heb
+        ]
+        docs.append(
+            {
+                "001_txt": str(i),
+                "245_a_txt": " ".join(rlist[0] for rlist in rlists),
+            }
+        )
+        parts = [st.or_(filter(None, r), fuzzy=True) for r in rlists if any(r)]
+        queries.append("alltitles:" + st.and_(parts, escape=False))
+
+    core = localsolr.LocalCore(docs, {"alltitles": ["245_a_txt"]})
+    server = localsolr.serve({"nlibooks": core}, port=0, delay=0.002)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    url = "http://{}:{}/nlibooks".format(host, port)
+    return st.SolrCore(url), queries
+
+
+@benchmark
+def solr_single(corpus):
+    """one HTTP request per query, against a local stand-in server."""
+    solr, queries = local_solr(corpus)
+
+    def run():
+        for query in queries:
+            solr.run_query(query)
+
+    return run, len(queries)
+
+
+@benchmark
+def solr_batch(corpus):
+    """the same queries as solr_single, 50 per request. The docs are ranked
+    by the whole batch, so the results aren't the same.
+    """
+    solr, queries = local_solr(corpus)
+
+    def run():
+        solr.run_queries(queries)
+
+    return run, len(queries)
+
+
+def timeit(run, repeat):
+    """best of ``repeat`` runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=str(ROOT),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names, corpus, repeat):
+    results = {}
+    for name in names:
+        try:
+            run, items = BENCHMARKS[name](corpus)
+        except ImportError as e:
+            results[name] = {"skipped": str(e)}
+            continue
+        run()  # warm up
+        seconds = timeit(run, repeat)
+        results[name] = {
+            "items": items,
+            "seconds": seconds,
+            "per_second": items / seconds,
+        }
+    return results
+
+
+def print_results(results, baseline=None):
+    baseline = (baseline or {}).get("results", {})
+    for name, result in results.items():
+        if "skipped" in result:
+            print("{:20} skipped ({})".format(name, result["skipped"]))
+            continue
+        out = "{:20} {:10.1f}/s".format(name, result["per_second"])
+        old = baseline.get(name, {}).get("per_second")
+        if old:
+            out += "  {:+.1%}".format(result["per_second"] / old - 1)
+        print(out)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("names", nargs="*", help="benchmarks to run (all)")
+    ap.add_argument("-o", "--output", help="write results to this file")
+    ap.add_argument("--compare", help="results file to compare against")
+    ap.add_argument("-r", "--repeat", type=int, default=5)
+    ap.add_argument("--list", action="store_true", help="list benchmarks")
+    args = ap.parse_args()
+
+    if args.list:
+        print(*BENCHMARKS, sep="\n")
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+    corpus = read_corpus()
+    names = args.names or list(BENCHMARKS)
+    results = run_benchmarks(names, corpus, args.repeat)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(
+                {
+                    "commit": git_commit(),
+                    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "corpus_lines": len(corpus),
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                fh,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
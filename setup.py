@@ -16,6 +16,11 @@ setup(
             "fl=arc.filters:main",
             "derom=arc.util:main",
             "dump-arc-config=arc.config:dump_config_file",
+            "arc-build-terms=arc.nlitools.terms:main",
+            "build-arc-cache=arc.cachebuild:main",
+            "arc-compile-profile=arc.profiles:main",
+            "arc-warm-cache=arc.warmup:main",
+            "arc-server=arc.server:main",
         ]
     },
     install_requires=[